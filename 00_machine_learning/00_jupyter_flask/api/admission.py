@@ -0,0 +1,86 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Overloaded(Exception):
+    # raised instead of queueing a request the server cannot serve in time. status is the
+    # http status to answer with and retry_after a hint in seconds for the client.
+
+    def __init__(self, reason, status, retry_after):
+        super(Overloaded, self).__init__(reason)
+        self.reason = reason
+        self.status = status
+        self.retry_after = retry_after
+
+
+class AdmissionController(object):
+    # lets at most max_concurrency requests run inference at once and at most max_queue
+    # more wait for a slot. anything beyond that is turned away straight away, as is a
+    # request whose projected wait, from the queue ahead of it and the average time a
+    # request holds a slot, is longer than deadline_ms. a request that is admitted to the
+    # queue but still has no slot at its deadline gives up too. that way a burst gets fast
+    # 429/503s the client can retry elsewhere, rather than piling up in memory and
+    # answering everyone late.
+
+    def __init__(self, max_concurrency=4, max_queue=8, deadline_ms=1000):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.deadline = deadline_ms / 1000
+        self.active = 0
+        self.waiting = 0
+        self.rejected = {'queue_full': 0, 'deadline': 0}
+        # moving average of how long a request holds a slot, seeded so the first burst is
+        # not admitted blindly
+        self.service_time = 0.05
+        self._cond = threading.Condition()
+
+    def projected_wait(self):
+        # seconds the next request would wait for a slot, the callers ahead of it are served
+        # max_concurrency at a time
+        return (self.waiting + 1) / self.max_concurrency * self.service_time
+
+    def _reject(self, reason, status):
+        self.rejected[reason] += 1
+        raise Overloaded(reason, status, max(1, int(round(self.projected_wait()))))
+
+    def acquire(self):
+        with self._cond:
+            if self.active < self.max_concurrency and self.waiting == 0:
+                self.active += 1
+                return
+            if self.waiting >= self.max_queue:
+                self._reject('queue_full', 429)
+            if self.projected_wait() > self.deadline:
+                self._reject('deadline', 503)
+            self.waiting += 1
+            try:
+                give_up_at = time.time() + self.deadline
+                while self.active >= self.max_concurrency:
+                    remaining = give_up_at - time.time()
+                    if remaining <= 0:
+                        self._reject('deadline', 503)
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.active += 1
+
+    def release(self, seconds):
+        with self._cond:
+            self.active -= 1
+            self.service_time += 0.1 * (seconds - self.service_time)
+            self._cond.notify()
+
+    @contextmanager
+    def admit(self):
+        self.acquire()
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.release(time.time() - start)
+
+    def stats(self):
+        with self._cond:
+            return {'active': self.active, 'waiting': self.waiting, 'rejected': dict(self.rejected),
+                    'service_seconds': self.service_time}
@@ -1,10 +1,23 @@
-from flask import Flask, jsonify, request
-import tensorflow as tf
-from tensorflow.keras.models import load_model
-from tensorflow.keras.preprocessing import image
+import time
+# startup is timed from here, before flask and TF are imported
+IMPORT_START = time.time()
+
+from flask import Flask, g, jsonify, request
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 import base64
+import binascii
+import os
 import numpy as np
+from PIL import UnidentifiedImageError
+
+from admission import AdmissionController, Overloaded
+from batcher import MicroBatcher
+from cache import PredictionCache, cache_key, make_backend
+from metrics import CallbackMetric, Counter, Gauge, Histogram, Registry
+from model_holder import MODEL_BACKEND, ModelHolder
+from model_registry import CASCADE_MODEL_PATH, ModelRegistry
+from preprocessing import BatchBuffer, load_image, normalize
 
 ############################# Initializae App #############################
 
@@ -12,38 +25,364 @@ app = Flask(__name__)
 
 ######################## Load Model, Def Functions ########################
 
+# every model version is loaded once per worker process and shared by every request
+# thread. new versions dropped into MODEL_DIR are loaded, warmed up and swapped in without
+# a restart, requests pick one with ?model_version= or the X-Model-Version header.
+model_registry = ModelRegistry()
+
+# concurrent requests are grouped into a single predict call, set BATCH_MAX_SIZE=1 to
+# send every request to the model on its own
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE') or 8)
+BATCH_MAX_WAIT_MS = float(os.environ.get('BATCH_MAX_WAIT_MS') or 10)
+
+# per stage latency and request metrics, served in prometheus' text format at /metrics
+registry = Registry()
+STAGE_SECONDS = Histogram('chart_classifier_stage_seconds', "Time spent in each stage of serving a request",
+                          ['stage'], registry=registry)
+REQUEST_SECONDS = Histogram('chart_classifier_request_seconds', "End to end request latency",
+                            ['endpoint'], registry=registry)
+REQUESTS = Counter('chart_classifier_requests_total', "Requests served", ['endpoint', 'status'], registry=registry)
+ERRORS = Counter('chart_classifier_errors_total', "Requests that failed with a 4xx or 5xx status",
+                 ['endpoint', 'status'], registry=registry)
+IMAGE_ERRORS = Counter('chart_classifier_image_errors_total', "Uploaded images that could not be read or decoded",
+                       registry=registry)
+IN_FLIGHT = Gauge('chart_classifier_in_flight_requests', "Requests currently being served", registry=registry)
+BATCH_SIZE = Histogram('chart_classifier_batch_size', "Images per model.predict call",
+                       buckets=(1, 2, 4, 8, 16, 32, 64, 128), registry=registry)
+CallbackMetric('chart_classifier_model_load_seconds', "Time it took to load each model version in this worker",
+               lambda: [((v['version'],), v['load_seconds']) for v in model_registry.versions()
+                        if v['load_seconds'] is not None],
+               labelnames=['version'], registry=registry)
+CallbackMetric('chart_classifier_startup_phase_seconds', "Time spent in each phase of starting this worker",
+               lambda: [((phase,), seconds) for phase, seconds in startup_phases().items()],
+               labelnames=['phase'], registry=registry)
+CallbackMetric('chart_classifier_ready', "1 once the model is loaded and warmed up in this worker",
+               lambda: int(model_registry.get().ready), registry=registry)
+
+# an optional cascade: a much smaller model trained by train.py --train_cascade 1
+# classifies every image first, and only images it is unsure about, with a probability
+# between CASCADE_LOW and CASCADE_HIGH, are escalated to the full model
+CASCADE_LOW = float(os.environ.get('CASCADE_LOW') or 0.2)
+CASCADE_HIGH = float(os.environ.get('CASCADE_HIGH') or 0.8)
+
+cascade_holder = ModelHolder(CASCADE_MODEL_PATH, MODEL_BACKEND) if CASCADE_MODEL_PATH else None
+
+CASCADE_IMAGES = Counter('chart_classifier_cascade_images_total',
+                         "Images answered by the small cascade model or escalated to the full model",
+                         ['result'], registry=registry)
+
+def run_on(batch, holder, stage):
+    BATCH_SIZE.observe(len(batch))
+    with STAGE_SECONDS.time(stage=stage):
+        return holder.predict(batch)
+
+def infer(batch, holder):
+    if cascade_holder is None:
+        return run_on(batch, holder, 'inference')
+    probs = run_on(batch, cascade_holder, 'cascade')
+    uncertain = (probs[:, 0] > CASCADE_LOW) & (probs[:, 0] < CASCADE_HIGH)
+    n_escalated = int(uncertain.sum())
+    CASCADE_IMAGES.inc(len(batch) - n_escalated, result='answered')
+    if n_escalated:
+        CASCADE_IMAGES.inc(n_escalated, result='escalated')
+        probs = probs.copy()
+        probs[uncertain] = run_on(batch[uncertain], holder, 'inference')
+    return probs
+
+def run_model(imgs, holder):
+    # imgs is a uint8 batch, it is scaled once for the whole batch right before inference.
+    # the holder comes with the images, so the batcher serves every model version
+    with STAGE_SECONDS.time(stage='normalize'):
+        batch = normalize(imgs)
+    return infer(batch, holder)
+
+batcher = MicroBatcher(run_model, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS) if BATCH_MAX_SIZE > 1 else None
+
+# the readiness check only passes once the model is loaded and has run a prediction at each
+# of these batch sizes, so new pods do not get traffic while they are still cold
+WARMUP_BATCH_SIZES = [int(n) for n in (os.environ.get('WARMUP_BATCH_SIZES') or f"1,{BATCH_MAX_SIZE}").split(",")]
+
+def warm_up():
+    model_registry.load_and_warmup(WARMUP_BATCH_SIZES)
+    if cascade_holder is not None:
+        cascade_holder.load_and_warmup(WARMUP_BATCH_SIZES)
+
+def startup_phases():
+    return dict(IMPORT_PHASES, **model_registry.get().startup_phases)
+
+# at most ADMISSION_MAX_CONCURRENCY requests decode and run inference at once and at most
+# ADMISSION_MAX_QUEUE wait for their turn. the rest, and requests that would wait longer
+# than ADMISSION_DEADLINE_MS, are turned away with a 429 or 503 instead of queueing.
+# a request holds its slot while it waits in the micro-batcher, so fewer slots than
+# BATCH_MAX_SIZE would keep batches from ever filling up. the queue holds one more batch
+ADMISSION_MAX_CONCURRENCY = int(os.environ.get('ADMISSION_MAX_CONCURRENCY') or max(4, BATCH_MAX_SIZE))
+ADMISSION_MAX_QUEUE = int(os.environ.get('ADMISSION_MAX_QUEUE') or ADMISSION_MAX_CONCURRENCY)
+ADMISSION_DEADLINE_MS = float(os.environ.get('ADMISSION_DEADLINE_MS') or 1000)
+
+admission = AdmissionController(ADMISSION_MAX_CONCURRENCY, ADMISSION_MAX_QUEUE, ADMISSION_DEADLINE_MS)
+
+CallbackMetric('chart_classifier_admission_waiting', "Requests waiting for an inference slot",
+               lambda: admission.waiting, registry=registry)
+CallbackMetric('chart_classifier_admission_rejected_total', "Requests turned away because the server was overloaded",
+               lambda: [((reason,), n) for reason, n in admission.stats()['rejected'].items()],
+               type='counter', labelnames=['reason'], registry=registry)
+
+# the bulk endpoint decodes images on a small thread pool and runs them through the model
+# in chunks, so one large request cannot blow up memory with a single giant batch
+BULK_MAX_IMAGES = int(os.environ.get('BULK_MAX_IMAGES') or 256)
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE') or 32)
+DECODE_WORKERS = int(os.environ.get('DECODE_WORKERS') or 4)
+
+decode_pool = ThreadPoolExecutor(max_workers=DECODE_WORKERS)
+
+# predictions are cached by a hash of the image bytes and the model version, so repeat
+# uploads of the same meme skip decoding and inference. CACHE_URL points at a shared
+# redis (or local:// for an in-process stand-in) that outlives the pod.
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES') or 10000)
+CACHE_TTL_SECONDS = float(os.environ.get('CACHE_TTL_SECONDS') or 3600)
+CACHE_URL = os.environ.get('CACHE_URL')
+
+prediction_cache = PredictionCache(CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS, make_backend(CACHE_URL)) if CACHE_MAX_ENTRIES > 0 else None
+
+def cache_counters():
+    if prediction_cache is None:
+        return None
+    stats = prediction_cache.stats()
+    return [((event,), stats[event]) for event in ('hits', 'misses', 'evictions', 'expirations')]
+
+CallbackMetric('chart_classifier_cache_events_total', "Prediction cache hits, misses, evictions and expirations",
+               cache_counters, type='counter', labelnames=['event'], registry=registry)
+
 def make_response(data, status_code):
-    return jsonify(data), status_code
+    with STAGE_SECONDS.time(stage='serialize'):
+        return jsonify(data), status_code
+
+def read_upload(upload):
+    # uploads are base64 strings from the encoded_image form field or multipart files
+    if isinstance(upload, (str, bytes)):
+        return base64.b64decode(upload)
+    return upload.read()
+
+def get_image_bytes():
+    # images can be uploaded as raw bytes, either as a multipart file called image or as
+    # an application/octet-stream body, which skips base64 on both ends. older clients
+    # still send the base64 encoded_image form field.
+    with STAGE_SECONDS.time(stage='read'):
+        if 'image' in request.files:
+            return read_upload(request.files['image'])
+        if request.mimetype == 'application/octet-stream':
+            return request.get_data(cache=False)
+        b64img = request.form.get('encoded_image')
+        if b64img is None:
+            return None
+        return read_upload(b64img)
+
+def get_model():
+    # the holder of the model version the request asked for, looked up once so the whole
+    # request is served by the same model even if a new one is swapped in meanwhile. the
+    # version that served it is returned in the X-Model-Version response header.
+    g.model_version, holder = model_registry.lookup(request.args.get('model_version') or
+                                                    request.headers.get('X-Model-Version'))
+    return holder
+
+def cache_lookup(image_bytes, holder):
+    # returns the cache key for the image and the cached prediction, if there is one
+    if prediction_cache is None:
+        return None, None
+    with STAGE_SECONDS.time(stage='cache_lookup'):
+        version = holder.version if cascade_holder is None else f"{holder.version}|{cascade_holder.version}"
+        key = cache_key(image_bytes, version)
+        return key, prediction_cache.get(key)
+
+def cache_store(key, data):
+    if key is not None:
+        prediction_cache.set(key, data)
 
-def decode_image(b64img):
-    img = image.img_to_array(image.load_img(BytesIO(base64.b64decode(b64img)),
-                                            target_size=(250, 250))) / 255
-    img = np.expand_dims(img, axis=0)
-    return img
+def predict_image(img, holder):
+    if batcher is None:
+        return run_model(img, holder)[0]
+    return batcher.predict(img, holder)
+
+def format_prediction(prob):
+    cla = "Chart" if prob > .5 else "Meme"
+    return {'probability': str(prob), 'class': cla}
+
+def try_read_upload(upload, holder):
+    # a malformed image should only fail its own entry in a bulk request
+    try:
+        with STAGE_SECONDS.time(stage='read'):
+            image_bytes = read_upload(upload)
+        key, cached = cache_lookup(image_bytes, holder)
+        return image_bytes, key, cached
+    except Exception as e:
+        IMAGE_ERRORS.inc()
+        return None, None, {'error': f"could not read image: {e}"}
+
+def try_fill(buffer, row, image_bytes):
+    try:
+        with STAGE_SECONDS.time(stage='decode'):
+            buffer.fill(row, BytesIO(image_bytes))
+        return None
+    except Exception as e:
+        IMAGE_ERRORS.inc()
+        return {'error': f"could not decode image: {e}"}
+
+def predict_images(uploads, holder):
+    # uploads are base64 strings or multipart files, entries that were cached or could not
+    # be read already have their result and skip the model
+    read = list(decode_pool.map(try_read_upload, uploads, [holder] * len(uploads)))
+    results = [result for _, _, result in read]
+
+    # the rest are decoded in parallel straight into one reused uint8 chunk buffer
+    pending = [i for i, (_, _, result) in enumerate(read) if result is None]
+    buffer = BatchBuffer(min(len(pending), BULK_CHUNK_SIZE), holder.img_size) if pending else None
+    for start in range(0, len(pending), BULK_CHUNK_SIZE):
+        chunk = pending[start:start + BULK_CHUNK_SIZE]
+        errors = list(decode_pool.map(try_fill, [buffer] * len(chunk), range(len(chunk)),
+                                      [read[i][0] for i in chunk]))
+
+        with STAGE_SECONDS.time(stage='normalize'):
+            batch = buffer.normalize(len(chunk))
+        probs = infer(batch, holder)
+        for row, i in enumerate(chunk):
+            if errors[row] is not None:
+                results[i] = errors[row]
+                continue
+            results[i] = format_prediction(probs[row][0])
+            cache_store(read[i][1], results[i])
+
+    return results
 
 ############################## Define Routes ##############################
+# request counters and latency for every route, including errors
+@app.before_request
+def start_request_timer():
+    g.start_time = time.perf_counter()
+    IN_FLIGHT.inc()
+
+@app.after_request
+def record_request(response):
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    if response.status_code >= 400:
+        ERRORS.inc(endpoint=endpoint, status=response.status_code)
+    REQUEST_SECONDS.observe(time.perf_counter() - g.start_time, endpoint=endpoint)
+    if 'model_version' in g:
+        response.headers['X-Model-Version'] = g.model_version
+    return response
+
+@app.teardown_request
+def end_request(exc):
+    if 'start_time' in g:
+        IN_FLIGHT.dec()
+
+# an overloaded server answers straight away and tells the client when to try again
+@app.errorhandler(Overloaded)
+def overloaded(e):
+    response, status = make_response({'error': f"server overloaded: {e.reason}"}, e.status)
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, status
+
 # this is a health check endpoint that is hit periodically by our infra to test the
-# app is still healthy
+# app is still healthy, it is the liveness check and passes as soon as the app is up
 @app.route('/health', methods=['GET'])
+@app.route('/health/live', methods=['GET'])
 def health_check():    
     data = {"health_check": "healthy"}
     return make_response(data, 200)
 
+# the readiness check passes once the model is loaded and warmed up. if nothing warmed the
+# model up before the server started (like gunicorn's post_worker_init does) the first
+# check starts it in the background.
+@app.route('/health/ready', methods=['GET'])
+def readiness_check():
+    holder = model_registry.get()
+    if not holder.ready:
+        model_registry.start_warmup(WARMUP_BATCH_SIZES)
+    ready = holder.ready
+    data = {"ready": ready, "startup_seconds": startup_phases()}
+    if holder.warmup_error is not None:
+        data["error"] = holder.warmup_error
+    return make_response(data, 200 if ready else 503)
+
 @app.route('/chart_classifier/predict', methods=['POST'])
 def predict():
-    # Decoding and pre-processing base64 image
-    b64img = request.form.get('encoded_image')
-    img = decode_image(b64img)
- 
-    # we are loading the model every time we get a request, which is really really bad
-    # ideally we should be loading the model on the main thread as a global variable,
-    # but the problem with this is that TF/Keras makes it really difficult to work with
-    # our model graph across multiple threads
-    model = load_model('cv_chart_model.h5')
-    prob = model.predict(img)[0][0]
-    
-    cla = "Chart" if prob > .5 else "Meme"
-    data = {'probability': str(prob), 'class': cla}
+    holder = get_model()
+    if holder is None:
+        return make_response({'error': "unknown model version"}, 404)
+    try:
+        image_bytes = get_image_bytes()
+    except binascii.Error as e:
+        IMAGE_ERRORS.inc()
+        return make_response({'error': f"could not read image: {e}"}, 400)
+    if image_bytes is None:
+        return make_response({'error': "no image in request"}, 400)
 
+    # repeat uploads are served from the cache without decoding the image
+    key, data = cache_lookup(image_bytes, holder)
+    if data is not None:
+        return make_response(data, 200)
+
+    with admission.admit():
+        # Decoding and pre-processing the uploaded image
+        try:
+            with STAGE_SECONDS.time(stage='decode'):
+                img = np.expand_dims(load_image(BytesIO(image_bytes), holder.img_size), axis=0)
+        except (UnidentifiedImageError, OSError) as e:
+            IMAGE_ERRORS.inc()
+            return make_response({'error': f"could not decode image: {e}"}, 400)
+
+        prob = predict_image(img, holder)[0]
+    data = format_prediction(prob)
+    cache_store(key, data)
+
+    return make_response(data, 200)
+
+
+@app.route('/chart_classifier/predict_batch', methods=['POST'])
+def predict_batch():
+    # images can be sent as repeated multipart image files, repeated encoded_image form
+    # fields or as a json list of base64 strings
+    holder = get_model()
+    if holder is None:
+        return make_response({'error': "unknown model version"}, 404)
+    if request.is_json:
+        payload = request.get_json(silent=True)
+        # a list or scalar body has no images either
+        uploads = payload.get('encoded_images') if isinstance(payload, dict) else None
+        if not isinstance(uploads, list):
+            uploads = []
+    else:
+        uploads = request.files.getlist('image') + request.form.getlist('encoded_image')
+
+    if not uploads:
+        return make_response({'error': "no images in request"}, 400)
+    if len(uploads) > BULK_MAX_IMAGES:
+        return make_response({'error': f"too many images, at most {BULK_MAX_IMAGES} per request"}, 413)
+
+    with admission.admit():
+        data = {'predictions': predict_images(uploads, holder)}
+
+    return make_response(data, 200)
+
+# hit, miss and eviction counters of the prediction cache
+@app.route('/chart_classifier/cache', methods=['GET'])
+def cache_stats():
+    if prediction_cache is None:
+        return make_response({'enabled': False}, 200)
+    data = dict(prediction_cache.stats(), enabled=True)
     return make_response(data, 200)
 
+# the model versions this worker serves and which one is the default
+@app.route('/chart_classifier/models', methods=['GET'])
+def model_versions():
+    data = {'versions': model_registry.versions()}
+    return make_response(data, 200)
+
+# per stage latency histograms, request and error counters in prometheus' text format
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return registry.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+# everything above ran at import time
+IMPORT_PHASES = {'import': time.time() - IMPORT_START}
@@ -0,0 +1,117 @@
+from aiohttp import web
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import asyncio
+import base64
+import binascii
+import os
+import numpy as np
+from PIL import UnidentifiedImageError
+
+from batcher import MicroBatcher
+from model_holder import ModelHolder
+from preprocessing import load_image, normalize
+
+# asyncio version of the chart classifier api, run it with
+#   python app_async.py
+# request bodies are read without blocking, so one process can keep many slow uploads
+# open, while decoding and inference run on a bounded thread pool
+
+############################# Initializae App #############################
+
+PORT = int(os.environ.get('PORT') or 5000)
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES') or 10 * 1024 * 1024)
+
+app = web.Application(client_max_size=MAX_UPLOAD_BYTES)
+
+######################## Load Model, Def Functions ########################
+
+model_holder = ModelHolder()
+
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE') or 8)
+BATCH_MAX_WAIT_MS = float(os.environ.get('BATCH_MAX_WAIT_MS') or 10)
+
+def run_model(imgs, holder=None):
+    return (holder or model_holder).predict(normalize(imgs))
+
+batcher = MicroBatcher(run_model, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS) if BATCH_MAX_SIZE > 1 else None
+
+# decoding and unbatched inference run on this pool. at most EXECUTOR_MAX_PENDING jobs are
+# handed to it at once, the rest wait on the event loop instead of piling up in its queue
+EXECUTOR_WORKERS = int(os.environ.get('EXECUTOR_WORKERS') or 4)
+EXECUTOR_MAX_PENDING = int(os.environ.get('EXECUTOR_MAX_PENDING') or 2 * EXECUTOR_WORKERS)
+
+executor = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS)
+
+async def run_in_executor(fn, *args):
+    async with app['executor_slots']:
+        return await asyncio.get_event_loop().run_in_executor(executor, fn, *args)
+
+def make_response(data, status_code):
+    return web.json_response(data, status=status_code)
+
+async def get_image_bytes(request):
+    # same upload formats as the flask api: a multipart file called image, an
+    # application/octet-stream body or the base64 encoded_image form field
+    if not request.can_read_body:
+        return None
+    if request.content_type == 'application/octet-stream':
+        return await request.read()
+    form = await request.post()
+    upload = form.get('image')
+    if isinstance(upload, web.FileField):
+        return await run_in_executor(upload.file.read)
+    b64img = form.get('encoded_image')
+    if b64img is None:
+        return None
+    return base64.b64decode(b64img)
+
+def decode_image(image_bytes):
+    return np.expand_dims(load_image(BytesIO(image_bytes), model_holder.img_size), axis=0)
+
+async def predict_image(img):
+    if batcher is None:
+        preds = await run_in_executor(run_model, img)
+        return preds[0]
+    # the batcher resolves a concurrent future from its own thread, awaiting it does not
+    # hold an executor thread
+    return await asyncio.wrap_future(batcher.submit(img))
+
+def format_prediction(prob):
+    cla = "Chart" if prob > .5 else "Meme"
+    return {'probability': str(prob), 'class': cla}
+
+############################## Define Routes ##############################
+
+async def health_check(request):
+    data = {"health_check": "healthy"}
+    return make_response(data, 200)
+
+async def predict(request):
+    try:
+        image_bytes = await get_image_bytes(request)
+    except binascii.Error as e:
+        return make_response({'error': f"could not read image: {e}"}, 400)
+    if image_bytes is None:
+        return make_response({'error': "no image in request"}, 400)
+
+    try:
+        img = await run_in_executor(decode_image, image_bytes)
+    except (UnidentifiedImageError, OSError) as e:
+        return make_response({'error': f"could not decode image: {e}"}, 400)
+
+    prob = (await predict_image(img))[0]
+    data = format_prediction(prob)
+
+    return make_response(data, 200)
+
+async def on_startup(app):
+    # the semaphore has to be created on the loop that serves requests
+    app['executor_slots'] = asyncio.Semaphore(EXECUTOR_MAX_PENDING)
+
+app.on_startup.append(on_startup)
+app.router.add_get('/health', health_check)
+app.router.add_post('/chart_classifier/predict', predict)
+
+if __name__ == '__main__':
+    web.run_app(app, host='0.0.0.0', port=PORT)
@@ -0,0 +1,151 @@
+import gzip
+import os
+from io import BytesIO
+
+import h5py
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.models import load_model
+
+from cpus import available_cpus
+
+# inference backends the api can serve the chart classifier with. each one is built from
+# the bytes of its model file and exposes input_shape and predict(batch) on a float32
+# batch scaled to [0, 1]. they are not thread safe, ModelHolder serializes calls.
+
+# TF sizes its thread pools by the host's cores, which on a node with many cores and a pod
+# with a small CPU limit means dozens of threads fighting over a fraction of a CPU. size
+# them by the container's quota instead. the model is a single chain of layers, so there
+# is little to run side by side between ops.
+TF_INTRA_OP_THREADS = int(os.environ.get('TF_INTRA_OP_THREADS') or available_cpus())
+TF_INTER_OP_THREADS = int(os.environ.get('TF_INTER_OP_THREADS') or 1)
+
+def configure_threads(intra=TF_INTRA_OP_THREADS, inter=TF_INTER_OP_THREADS):
+    # has to run before TF's runtime starts, i.e. before the first model is built
+    if hasattr(tf, 'config') and hasattr(tf.config, 'threading'):
+        try:
+            tf.config.threading.set_intra_op_parallelism_threads(intra)
+            tf.config.threading.set_inter_op_parallelism_threads(inter)
+        except RuntimeError as e:
+            print(f"Could not set TF thread counts, the runtime is already running: {e}")
+
+configure_threads()
+
+
+class KerasBackend(object):
+    # the keras .h5 model as trained. TF1/Keras ties a model to the graph and session it
+    # was built in, and flask serves every request on its own thread, so we keep a handle
+    # on both and re-enter them before calling predict.
+
+    def __init__(self, model_bytes):
+        if not tf.executing_eagerly():
+            # TF1 takes the thread counts per session
+            config = tf.compat.v1.ConfigProto(intra_op_parallelism_threads=TF_INTRA_OP_THREADS,
+                                              inter_op_parallelism_threads=TF_INTER_OP_THREADS)
+            tf.compat.v1.keras.backend.set_session(tf.compat.v1.Session(config=config))
+        if model_bytes[:2] == b'\x1f\x8b':
+            # gzipped .h5, like the pruned model from 01_sagemaker/train.py --prune 1
+            model_bytes = gzip.decompress(model_bytes)
+        self.model = load_model(h5py.File(BytesIO(model_bytes), 'r'))
+        self.input_shape = tuple(self.model.input_shape)
+        self._graph = None
+        self._session = None
+        if not tf.executing_eagerly():
+            self._graph = tf.compat.v1.get_default_graph()
+            self._session = tf.compat.v1.keras.backend.get_session()
+
+    def predict(self, batch):
+        if self._graph is None:
+            return self.model.predict(batch, verbose=0)
+        with self._graph.as_default():
+            tf.compat.v1.keras.backend.set_session(self._session)
+            return self.model.predict(batch, verbose=0)
+
+
+# largest batch a TFLite interpreter is allocated for, bigger batches run in pieces
+TFLITE_MAX_BATCH = int(os.environ.get('TFLITE_MAX_BATCH') or 8)
+
+
+class TFLiteBackend(object):
+    # a TFLite flatbuffer written by export_model.py, float or int8 quantized. inputs and
+    # outputs stay float32 in both cases, so it is a drop in replacement for keras.
+    # an interpreter is allocated for one batch size and resizing it costs about as much as
+    # running it, while the micro-batcher and bulk chunks send a different size on nearly
+    # every call. so every power of two up to max_batch gets its own interpreter, built on
+    # first use, and a batch runs as power of two pieces, e.g. 13 as 8 + 4 + 1. per image
+    # cost is flat above a few images, so the pieces cost next to nothing, and memory stays
+    # bounded by the activations of 2 * max_batch images.
+
+    def __init__(self, model_bytes, num_threads=TF_INTRA_OP_THREADS, max_batch=TFLITE_MAX_BATCH):
+        self._model_bytes = model_bytes
+        self._num_threads = num_threads
+        self._max_batch = 1 << (max(1, max_batch).bit_length() - 1)
+        self._interpreters = {}
+        interpreter = self._interpreter(1)
+        self._input = interpreter.get_input_details()[0]
+        self._output = interpreter.get_output_details()[0]
+        self.input_shape = (None,) + tuple(self._input['shape'][1:])
+
+    def _interpreter(self, batch_size):
+        interpreter = self._interpreters.get(batch_size)
+        if interpreter is None:
+            try:
+                interpreter = tf.lite.Interpreter(model_content=self._model_bytes, num_threads=self._num_threads)
+            except TypeError:
+                # older TF versions do not take num_threads
+                interpreter = tf.lite.Interpreter(model_content=self._model_bytes)
+            input_details = interpreter.get_input_details()[0]
+            if input_details['shape'][0] != batch_size:
+                interpreter.resize_tensor_input(input_details['index'], [batch_size] + list(input_details['shape'][1:]))
+            interpreter.allocate_tensors()
+            self._interpreters[batch_size] = interpreter
+        return interpreter
+
+    def predict(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        outputs = []
+        start = 0
+        while start < len(batch):
+            size = min(self._max_batch, 1 << ((len(batch) - start).bit_length() - 1))
+            interpreter = self._interpreter(size)
+            interpreter.set_tensor(self._input['index'], batch[start:start + size])
+            interpreter.invoke()
+            outputs.append(interpreter.get_tensor(self._output['index']))
+            start += size
+        if not outputs:
+            return np.zeros((0,) + tuple(self._output['shape'][1:]), dtype=np.float32)
+        return np.concatenate(outputs) if len(outputs) > 1 else outputs[0]
+
+
+# backend name -> (backend class, suffix of the model file next to the keras model)
+BACKENDS = {
+    'keras': (KerasBackend, '.h5'),
+    'tflite': (TFLiteBackend, '.tflite'),
+    'tflite_int8': (TFLiteBackend, '_int8.tflite'),
+}
+
+# 'auto' serves the cheapest format that has been exported
+AUTO_ORDER = ['tflite_int8', 'tflite', 'keras']
+
+def model_stem(model_path):
+    # the model path without .h5 or .h5.gz
+    if model_path.endswith('.gz'):
+        model_path = model_path[:-3]
+    return os.path.splitext(model_path)[0]
+
+def backend_path(model_path, name):
+    return model_stem(model_path) + BACKENDS[name][1]
+
+def resolve_backend(requested, model_path):
+    # returns the backends to try in order, each as (name, path). keras is always the
+    # last resort, so a missing or broken export falls back to the trained model
+    names = AUTO_ORDER if requested == 'auto' else [requested, 'keras']
+    candidates = []
+    for name in names:
+        path = model_path if name == 'keras' else backend_path(model_path, name)
+        if (name, path) not in candidates and (name == 'keras' or os.path.exists(path)):
+            candidates.append((name, path))
+    return candidates
+
+def build_backend(name, model_bytes):
+    return BACKENDS[name][0](model_bytes)
@@ -0,0 +1,130 @@
+import argparse
+import importlib.util
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from itertools import islice
+
+import numpy as np
+
+from preprocessing import IMG_SIZE, load_image, normalize
+
+# offline batch inference over a directory tree of images, e.g. to reclassify an archive
+# without going through the http api
+#
+#   python batch_predict.py -d ../data/test -o predictions.parquet
+#
+# images are decoded and resized in a pool of worker processes, which keep the next
+# --prefetch batches ready while the model runs on the current one. only that many
+# batches are ever in memory, however many images there are. results are appended to a
+# parquet file (needs pyarrow) one row group per batch.
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+ap = argparse.ArgumentParser()
+ap.add_argument("-d", "--data_dir", required=True,
+                help="directory of images, searched recursively")
+ap.add_argument("-o", "--output", default='predictions.parquet',
+                help="parquet file to write")
+ap.add_argument("-m", "--model", default='cv_chart_model.h5',
+                help="path of the keras model")
+ap.add_argument("--backend", default='keras',
+                help="keras, tflite, tflite_int8 or auto, see backends.py")
+ap.add_argument("-b", "--batch_size", type=int, default=64,
+                help="images per model.predict call")
+ap.add_argument("-w", "--workers", type=int, default=max(1, multiprocessing.cpu_count() - 1),
+                help="decode worker processes")
+ap.add_argument("-p", "--prefetch", type=int, default=2,
+                help="batches decoded ahead of the model, per worker")
+
+def walk_images(data_dir):
+    # a generator, so the list of files is never held in memory all at once
+    for root, dirs, files in os.walk(data_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(root, name)
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def decode_batch(paths, img_size=IMG_SIZE):
+    # runs in a worker process. a file that cannot be decoded only fails its own row.
+    images = np.zeros((len(paths), img_size, img_size, 3), dtype=np.uint8)
+    errors = [None] * len(paths)
+    for i, path in enumerate(paths):
+        try:
+            images[i] = load_image(path, img_size)
+        except Exception as e:
+            errors[i] = str(e)
+    return paths, images, errors
+
+def make_writer(output):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pa.schema([('path', pa.string()), ('probability', pa.float32()),
+                        ('class', pa.string()), ('error', pa.string())])
+
+    def write(writer, paths, probs, errors):
+        ok = [e is None for e in errors]
+        table = pa.Table.from_arrays([
+            pa.array(paths, pa.string()),
+            pa.array([float(p) if o else None for p, o in zip(probs, ok)], pa.float32()),
+            pa.array([("Chart" if p > .5 else "Meme") if o else None for p, o in zip(probs, ok)], pa.string()),
+            pa.array(errors, pa.string()),
+        ], schema=schema)
+        writer.write_table(table)
+
+    return pq.ParquetWriter(output, schema), write
+
+if __name__ == '__main__':
+    args = vars(ap.parse_args())
+    # checked before the pool and model start, without importing it before the fork
+    if importlib.util.find_spec('pyarrow') is None:
+        sys.exit("batch_predict.py writes parquet and needs pyarrow: pip install pyarrow")
+
+    # the pool is started before TF is imported so the workers never inherit its threads
+    pool = multiprocessing.Pool(args['workers'])
+
+    from model_holder import ModelHolder
+    model_holder = ModelHolder(args['model'], args['backend'])
+    model_holder.warmup()
+    img_size = model_holder.get().input_shape[1]
+
+    writer, write = make_writer(args['output'])
+    pending = deque()
+    n_images, n_errors = 0, 0
+    start = time.time()
+
+    def consume(result):
+        global n_images, n_errors
+        paths, images, errors = result.get()
+        probs = model_holder.predict(normalize(images))[:, 0]
+        write(writer, paths, probs, errors)
+        n_images += len(paths)
+        n_errors += sum(e is not None for e in errors)
+        elapsed = time.time() - start
+        print(f"{n_images} images, {n_images / elapsed:.1f} images/s", end='\r', flush=True)
+
+    for chunk in chunks(walk_images(args['data_dir']), args['batch_size']):
+        pending.append(pool.apply_async(decode_batch, (chunk, img_size)))
+        if len(pending) >= args['prefetch'] * args['workers']:
+            consume(pending.popleft())
+    while pending:
+        consume(pending.popleft())
+
+    writer.close()
+    pool.close()
+    pool.join()
+
+    elapsed = time.time() - start
+    print()
+    print(f"classified {n_images - n_errors}/{n_images} images in {elapsed:.1f}s "
+          f"({n_images / max(elapsed, 1e-9):.1f} images/s, {n_errors} errors) -> {args['output']}")
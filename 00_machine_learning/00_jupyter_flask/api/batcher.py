@@ -0,0 +1,89 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class MicroBatcher(object):
+    # collects images from concurrent requests into one batched predict call.
+    # a batch is sent to the model as soon as it has max_batch_size images or the oldest
+    # image in it has waited max_wait_ms, so no request waits longer than the deadline
+    # for company before inference starts. images submitted for different models, e.g.
+    # two versions of the classifier, are never put in the same batch.
+
+    def __init__(self, predict_fn, max_batch_size=8, max_wait_ms=10):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = None
+        self._pid = None
+        self._held = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_worker(self):
+        # the worker thread is started on first use, and again in a forked child since
+        # threads do not survive a fork
+        if self._pid != os.getpid():
+            with self._start_lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue()
+                    self._held = None
+                    worker = threading.Thread(target=self._run, args=(self._queue,),
+                                              name='micro-batcher', daemon=True)
+                    worker.start()
+                    self._pid = os.getpid()
+
+    def submit(self, img, model=None):
+        # img is a single image batch of shape (1, height, width, channels), the future
+        # resolves to that image's row of the model output. model is passed on to
+        # predict_fn along with the batch.
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((time.time(), model, img, future))
+        return future
+
+    def predict(self, img, model=None, timeout=None):
+        return self.submit(img, model).result(timeout)
+
+    def _collect(self, work_queue):
+        # block until there is work, then keep filling the batch until it is full or the
+        # oldest request hits its deadline. requests that queued up while the model was
+        # busy are past their deadline already, so those are taken without waiting. an
+        # image for another model ends the batch and starts the next one.
+        if self._held is not None:
+            enqueued_at, model, img, future = self._held
+            self._held = None
+        else:
+            enqueued_at, model, img, future = work_queue.get()
+        batch = [(img, future)]
+        deadline = enqueued_at + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    item = work_queue.get(timeout=remaining)
+                else:
+                    item = work_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item[1] is not model:
+                self._held = item
+                break
+            batch.append((item[2], item[3]))
+        return model, batch
+
+    def _run(self, work_queue):
+        while True:
+            model, batch = self._collect(work_queue)
+            futures = [future for _, future in batch]
+            try:
+                preds = self.predict_fn(np.concatenate([img for img, _ in batch], axis=0), model)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            for future, pred in zip(futures, preds):
+                future.set_result(pred)
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+def cache_key(image_bytes, model_version):
+    # the same image served by a different model must not hit a stale prediction
+    h = hashlib.sha256(model_version.encode('utf-8'))
+    h.update(image_bytes)
+    return h.hexdigest()
+
+
+class PredictionCache(object):
+    # a size bounded LRU of predictions keyed by cache_key, entries also expire after
+    # ttl seconds. an optional shared backend is checked on a local miss, so entries
+    # written by any pod (or before a restart) can be reused.
+
+    def __init__(self, max_entries=10000, ttl=3600, backend=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+                self.expirations += 1
+
+        value = self.backend.get(key) if self.backend is not None else None
+        if value is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+            self._put(key, value, now)
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._put(key, value, time.time())
+        if self.backend is not None:
+            self.backend.set(key, value, self.ttl)
+
+    def _put(self, key, value, now):
+        self._entries[key] = (now + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'max_entries': self.max_entries,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations}
+
+
+class KeyValueBackend(object):
+    # stores predictions as json in anything with a redis style get/setex interface,
+    # failures of the shared store are treated as misses so the api keeps serving
+
+    def __init__(self, client, prefix='chart_classifier:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        try:
+            value = self.client.get(self.prefix + key)
+        except Exception:
+            return None
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl):
+        try:
+            self.client.setex(self.prefix + key, int(ttl), json.dumps(value))
+        except Exception:
+            pass
+
+
+class LocalKeyValueStore(object):
+    # in-process stand-in for a redis client, handy for running the shared cache path
+    # locally and in tests without a redis server
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.time():
+                del self._data[key]
+                return None
+            return value
+
+    def setex(self, key, ttl, value):
+        with self._lock:
+            self._data[key] = (time.time() + ttl, value)
+
+
+def make_backend(url):
+    # local:// uses the in-process stand-in, anything else is handed to redis
+    if not url:
+        return None
+    if url.startswith('local://'):
+        return KeyValueBackend(LocalKeyValueStore())
+    import redis
+    return KeyValueBackend(redis.StrictRedis.from_url(url, socket_timeout=0.05))
@@ -0,0 +1,34 @@
+import math
+import multiprocessing
+
+# how many CPUs the container may actually use. kubernetes cpu limits are enforced with a
+# CFS quota, which os.cpu_count() does not see, so read it from the cgroup first.
+
+def cgroup_cpu_quota():
+    # cgroup v2 keeps "<quota> <period>" in one file, v1 splits them, -1 or max is unlimited
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        if quota > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+def available_cpus():
+    # whole CPUs we can keep busy, at least one even under a fractional quota like 0.5
+    quota = cgroup_cpu_quota()
+    host = multiprocessing.cpu_count()
+    if quota is None:
+        return host
+    return max(1, min(host, int(math.ceil(quota))))
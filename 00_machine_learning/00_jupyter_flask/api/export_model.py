@@ -0,0 +1,69 @@
+import argparse
+import glob
+import os
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.models import load_model
+
+from backends import backend_path
+from preprocessing import load_image, normalize
+
+# converts the trained keras model into TFLite flatbuffers for faster CPU inference:
+#   cv_chart_model.tflite       float32
+#   cv_chart_model_int8.tflite  post-training int8 quantized, calibrated on training images
+# both are written next to the keras model, where MODEL_BACKEND=tflite / tflite_int8 / auto
+# picks them up
+
+ap = argparse.ArgumentParser()
+ap.add_argument("-m", "--model", default='cv_chart_model.h5',
+                help="path of the keras model")
+ap.add_argument("-d", "--calibration_dir", default=os.path.join('..', 'data', 'train'),
+                help="directory of images used to calibrate int8 quantization, searched recursively")
+ap.add_argument("-n", "--n_calibration", type=int, default=200,
+                help="number of calibration images")
+args = vars(ap.parse_args())
+
+def make_converter(model_path):
+    # TF 1.x converts from the model file, TF 2.x from the loaded model
+    if hasattr(tf.lite.TFLiteConverter, 'from_keras_model_file'):
+        return tf.lite.TFLiteConverter.from_keras_model_file(model_path)
+    return tf.lite.TFLiteConverter.from_keras_model(load_model(model_path))
+
+def calibration_data(calibration_dir, n, img_size):
+    paths = sorted(glob.glob(os.path.join(calibration_dir, '**', '*.png'), recursive=True))
+    # spread the sample across classes rather than taking the first n files
+    paths = paths[::max(1, len(paths) // n)][:n]
+    def gen():
+        for path in paths:
+            yield [normalize(load_image(path, img_size)[np.newaxis])]
+    return gen
+
+def export_float(model_path):
+    return make_converter(model_path).convert()
+
+def export_int8(model_path, calibration_dir, n, img_size):
+    converter = make_converter(model_path)
+    if hasattr(tf.lite, 'Optimize'):
+        # weights and activations are quantized to int8 using ranges measured on the
+        # calibration images, model inputs and outputs stay float32
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = calibration_data(calibration_dir, n, img_size)
+    else:
+        # TF 1.13 only supports quantizing the weights
+        converter.post_training_quantize = True
+    return converter.convert()
+
+if __name__ == '__main__':
+    model_path = args['model']
+    img_size = load_model(model_path).input_shape[1]
+
+    exports = [('tflite', export_float(model_path)),
+               ('tflite_int8', export_int8(model_path, args['calibration_dir'], args['n_calibration'], img_size))]
+
+    print(f"keras model {model_path}: {os.path.getsize(model_path) / 1e6:.1f}MB")
+    for name, flatbuffer in exports:
+        path = backend_path(model_path, name)
+        with open(path, 'wb') as f:
+            f.write(flatbuffer)
+        print(f"{name} model {path}: {len(flatbuffer) / 1e6:.1f}MB")
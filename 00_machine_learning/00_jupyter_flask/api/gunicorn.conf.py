@@ -0,0 +1,59 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from cpus import available_cpus
+
+# production server for the chart classifier, run with
+#   gunicorn -c gunicorn.conf.py app:app
+# every setting can be overridden through the environment of the container
+
+bind = '0.0.0.0:' + (os.environ.get('PORT') or '5000')
+
+# one worker process per CPU in the container's quota, each with enough threads that
+# requests arriving together can be grouped by the micro-batcher, and that requests beyond
+# what the app admits to inference (ADMISSION_* in app.py) still get a thread to be
+# turned away on and health checks are answered during a burst
+workers = int(os.environ.get('WEB_CONCURRENCY') or available_cpus())
+worker_class = 'gthread'
+threads = int(os.environ.get('WORKER_THREADS') or 32)
+
+# the workers split the quota between them, so TF in each one gets its share of threads
+os.environ.setdefault('TF_INTRA_OP_THREADS', str(max(1, available_cpus() // workers)))
+
+# opt-in recycling of workers after a number of requests, to cap slow memory growth. off
+# by default: every restart pays a cold warmup while requests queue, and loses the
+# worker's prediction cache, metrics and batcher. the jitter keeps workers from all
+# restarting at once
+max_requests = int(os.environ.get('MAX_REQUESTS') or 0)
+max_requests_jitter = int(os.environ.get('MAX_REQUESTS_JITTER') or 0)
+
+# on SIGTERM, workers stop accepting connections and get this long to finish in-flight
+# requests, which should be shorter than the pod's terminationGracePeriodSeconds
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT') or 25)
+timeout = int(os.environ.get('WORKER_TIMEOUT') or 60)
+keepalive = int(os.environ.get('KEEPALIVE') or 5)
+
+# import the app, and with it TF, and read the model file in the master so that forked
+# workers share those memory pages instead of each paying for them
+preload_app = (os.environ.get('PRELOAD_MODEL') or '1') == '1'
+
+accesslog = '-'
+
+def when_ready(server):
+    # runs in the master before any worker is forked
+    if preload_app:
+        import app
+        app.model_registry.preload()
+        if app.cascade_holder is not None:
+            app.cascade_holder.preload()
+        server.log.info("Model versions %s read into memory before forking workers",
+                        ", ".join(v['version'] for v in app.model_registry.versions()))
+
+def post_worker_init(worker):
+    # build the worker's own model and run a first prediction before it takes traffic
+    import app
+    app.warm_up()
+    worker.log.info("Worker ready, startup phases: %s",
+                    ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in app.startup_phases().items()))
@@ -0,0 +1,145 @@
+import os
+import threading
+import time
+
+import numpy as np
+
+from backends import build_backend, resolve_backend
+
+# path to the trained model, can be overridden so the same image can serve another model file
+MODEL_PATH = os.environ.get('MODEL_PATH') or 'cv_chart_model.h5'
+# keras, tflite, tflite_int8 or auto, see backends.py. anything other than keras falls
+# back to the keras model when its export is missing or fails to load
+MODEL_BACKEND = os.environ.get('MODEL_BACKEND') or 'keras'
+# a background warmup that failed is retried after this many seconds, doubling up to
+# WARMUP_RETRY_MAX_SECONDS while it keeps failing
+WARMUP_RETRY_SECONDS = float(os.environ.get('WARMUP_RETRY_SECONDS') or 1)
+WARMUP_RETRY_MAX_SECONDS = float(os.environ.get('WARMUP_RETRY_MAX_SECONDS') or 60)
+
+
+class ModelHolder(object):
+    # holds a single copy of our model per worker process and shares it across flask's
+    # request threads. the lock serializes inference, which is what we want on a pod
+    # with half a CPU anyway.
+
+    def __init__(self, model_path=MODEL_PATH, backend=MODEL_BACKEND):
+        self.model_path = model_path
+        self.backend = backend
+        self.backend_name = None
+        self.load_time = None
+        self._version = None
+        self._model = None
+        self._pid = None
+        self._preloaded = None
+        self.startup_phases = {}
+        self.warmup_error = None
+        self._ready_pid = None
+        self._warmup_pid = None
+        self._warmup_failures = 0
+        self._warmup_retry_at = 0
+        self._load_lock = threading.Lock()
+        self._predict_lock = threading.Lock()
+
+    def get(self):
+        # the model is loaded lazily on first use and only once per process, the pid
+        # check makes sure a forked worker never reuses a graph built by its parent
+        if self._model is None or self._pid != os.getpid():
+            with self._load_lock:
+                if self._model is None or self._pid != os.getpid():
+                    self._load()
+        return self._model
+
+    @property
+    def version(self):
+        # identifies the model file and backend that were loaded, so predictions cached
+        # for one model are never served for another
+        self.get()
+        return self._version
+
+    @property
+    def img_size(self):
+        # images are decoded straight to the resolution the model was trained at
+        return self.get().input_shape[1]
+
+    def preload(self):
+        # called in the gunicorn master before it forks. TF's runtime threads do not
+        # survive a fork, so building the model here would hang the workers. instead the
+        # master pays for importing TF and reads the model files into memory once, and
+        # forked workers share those pages copy-on-write and build their model from the
+        # in-memory files without touching the disk.
+        self._preloaded = [self._read(name, path) for name, path in resolve_backend(self.backend, self.model_path)]
+
+    def warmup(self, batch_size=1):
+        # the first predict call builds the inference function, pay for it up front
+        _, height, width, channels = self.get().input_shape
+        self.predict(np.zeros((batch_size, height, width, channels), dtype=np.float32))
+
+    @property
+    def ready(self):
+        # true once load_and_warmup has finished in this process
+        return self._ready_pid == os.getpid()
+
+    def load_and_warmup(self, batch_sizes=(1,)):
+        # loads the model and runs a warmup prediction at each batch size, recording how
+        # long each phase took
+        self.get()
+        self.startup_phases['model_load'] = self.load_time
+        start = time.time()
+        for batch_size in batch_sizes:
+            self.warmup(batch_size)
+        self.startup_phases['warmup'] = time.time() - start
+        self._ready_pid = os.getpid()
+
+    def start_warmup(self, batch_sizes=(1,)):
+        # runs load_and_warmup on a background thread, one at a time per process, so a
+        # server that was not warmed up before taking traffic can get ready while it
+        # answers health checks. a failed warmup is started again by a later call once its
+        # backoff has passed, so a transient error does not leave the pod unready for good
+        with self._load_lock:
+            if self._warmup_pid == os.getpid() or time.time() < self._warmup_retry_at:
+                return
+            self._warmup_pid = os.getpid()
+
+        def run():
+            try:
+                self.load_and_warmup(batch_sizes)
+                self.warmup_error = None
+            except Exception as e:
+                self.warmup_error = str(e)
+                backoff = min(WARMUP_RETRY_SECONDS * 2 ** self._warmup_failures, WARMUP_RETRY_MAX_SECONDS)
+                self._warmup_failures += 1
+                print(f"Model warmup failed, retrying in {backoff:g}s: {e}")
+                with self._load_lock:
+                    self._warmup_retry_at = time.time() + backoff
+                    self._warmup_pid = None
+
+        threading.Thread(target=run, name='model-warmup', daemon=True).start()
+
+    def _read(self, name, path):
+        stat = os.stat(path)
+        with open(path, 'rb') as f:
+            model_bytes = f.read()
+        return name, model_bytes, f"{name}:{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    def _load(self):
+        start = time.time()
+        candidates = self._preloaded or resolve_backend(self.backend, self.model_path)
+        for i, candidate in enumerate(candidates):
+            name, model_bytes, version = candidate if self._preloaded else self._read(*candidate)
+            try:
+                model = build_backend(name, model_bytes)
+                break
+            except Exception as e:
+                if i == len(candidates) - 1:
+                    raise
+                print(f"Could not load the {name} backend, falling back: {e}")
+        self.backend_name = name
+        self._version = version
+        self._model = model
+        self._pid = os.getpid()
+        self.load_time = time.time() - start
+
+    def predict(self, batch):
+        model = self.get()
+        with self._predict_lock:
+            return model.predict(batch)
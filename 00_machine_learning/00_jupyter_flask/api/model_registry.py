@@ -0,0 +1,151 @@
+import glob
+import os
+import threading
+import time
+
+from backends import model_stem
+from model_holder import MODEL_BACKEND, MODEL_PATH, ModelHolder
+
+# directory of keras models to serve, one version per .h5 or gzipped .h5.gz file named
+# after the file, e.g. models/cv_chart_model_v2.h5 is version cv_chart_model_v2. exported tflite models sit next
+# to their .h5 like they do for MODEL_PATH. without MODEL_DIR only MODEL_PATH is served.
+MODEL_DIR = os.environ.get('MODEL_DIR')
+# version served when a request does not ask for one, defaults to the newest file
+MODEL_DEFAULT_VERSION = os.environ.get('MODEL_DEFAULT_VERSION')
+# how often the model files are checked for new or changed versions, 0 turns reloading off
+MODEL_POLL_SECONDS = float(os.environ.get('MODEL_POLL_SECONDS') or 10)
+# the small model of the cascade is not a version of its own, even when it sits in
+# MODEL_DIR as CASCADE_MODEL_PATH or under the name train.py saves it with,
+# cv_chart_model_small.h5
+CASCADE_MODEL_PATH = os.environ.get('CASCADE_MODEL_PATH')
+CASCADE_MODEL_SUFFIX = '_small'
+
+
+class ModelRegistry(object):
+    # the model versions a worker serves, each in its own ModelHolder. a background thread
+    # watches the model files and loads and warms up new or changed versions off the
+    # request path, then swaps them in. requests look their holder up once and keep it,
+    # so a request that started on the old model finishes on it, and the old model is
+    # freed once the last of them is done.
+
+    def __init__(self, model_dir=MODEL_DIR, model_path=MODEL_PATH, backend=MODEL_BACKEND,
+                 default_version=MODEL_DEFAULT_VERSION, poll_seconds=MODEL_POLL_SECONDS):
+        self.model_dir = model_dir
+        self.model_path = model_path
+        self.backend = backend
+        self.poll_seconds = poll_seconds
+        self.warmup_batch_sizes = (1,)
+        self._default_version = default_version
+        self._lock = threading.Lock()
+        self._pid = None
+        # file stats of versions that failed to load, so they are only retried once changed
+        self._failed = {}
+        # version -> (holder, file stat), replaced as a whole on every swap
+        self._versions = {name: (ModelHolder(path, backend), stat) for name, (path, stat) in self._scan().items()}
+        if not self._versions:
+            raise FileNotFoundError(f"no models found in {model_dir or model_path}")
+
+    def _scan(self):
+        # version -> (path, size and mtime) of every model file
+        if self.model_dir:
+            paths = sorted(glob.glob(os.path.join(self.model_dir, '*.h5')) + glob.glob(os.path.join(self.model_dir, '*.h5.gz')))
+        else:
+            paths = [self.model_path]
+        versions = {}
+        cascade_path = os.path.realpath(CASCADE_MODEL_PATH) if CASCADE_MODEL_PATH else None
+        for path in paths:
+            name = model_stem(os.path.basename(path))
+            if self.model_dir and (name.endswith(CASCADE_MODEL_SUFFIX) or os.path.realpath(path) == cascade_path):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            versions[name] = (path, (stat.st_size, stat.st_mtime_ns))
+        return versions
+
+    def _default(self, versions):
+        if self._default_version in versions:
+            return self._default_version
+        return max(versions, key=lambda name: versions[name][1][1])
+
+    @property
+    def default_version(self):
+        return self._default(self._versions)
+
+    def lookup(self, version=None):
+        # (version, holder) of the requested version, or of the default one. the holder is
+        # None if there is no such version.
+        self._ensure_watcher()
+        versions = self._versions
+        entry = versions.get(version or self._default(versions))
+        return version or self._default(versions), entry[0] if entry is not None else None
+
+    def get(self, version=None):
+        return self.lookup(version)[1]
+
+    def versions(self):
+        versions = self._versions
+        default = self._default(versions)
+        return [{'version': name, 'path': holder.model_path, 'backend': holder.backend_name,
+                 'load_seconds': holder.load_time, 'ready': holder.ready, 'default': name == default}
+                for name, (holder, _) in sorted(versions.items())]
+
+    def preload(self):
+        # reads every version into memory in the gunicorn master, see ModelHolder.preload
+        for holder, _ in self._versions.values():
+            holder.preload()
+
+    def load_and_warmup(self, batch_sizes=(1,)):
+        # loads and warms up every version, and remembers the batch sizes for the versions
+        # that show up later
+        self.warmup_batch_sizes = tuple(batch_sizes)
+        for holder, _ in self._versions.values():
+            holder.load_and_warmup(batch_sizes)
+        self._ensure_watcher()
+
+    def start_warmup(self, batch_sizes=(1,)):
+        self.warmup_batch_sizes = tuple(batch_sizes)
+        self.get().start_warmup(batch_sizes)
+
+    def _ensure_watcher(self):
+        # like the micro-batcher, the watcher thread is started on first use in each
+        # process, so the gunicorn master never runs it
+        if self.poll_seconds > 0 and self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    threading.Thread(target=self._watch, name='model-watcher', daemon=True).start()
+                    self._pid = os.getpid()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_seconds)
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Could not refresh the model registry: {e}")
+
+    def refresh(self):
+        # loads and warms up new or changed versions before swapping them in, a version
+        # that fails to load keeps serving its previous model
+        scanned = self._scan()
+        for name, (path, stat) in scanned.items():
+            current = self._versions.get(name)
+            if (current is not None and current[1] == stat) or self._failed.get(name) == stat:
+                continue
+            holder = ModelHolder(path, self.backend)
+            try:
+                holder.load_and_warmup(self.warmup_batch_sizes)
+            except Exception as e:
+                print(f"Could not load model version {name}, keeping the current one: {e}")
+                self._failed[name] = stat
+                continue
+            with self._lock:
+                self._versions = dict(self._versions, **{name: (holder, stat)})
+            print(f"Model version {name} loaded in {holder.load_time:.2f}s and swapped in")
+
+        removed = set(self._versions) - set(scanned)
+        if removed and len(removed) < len(self._versions):
+            with self._lock:
+                self._versions = {name: entry for name, entry in self._versions.items() if name not in removed}
+            print(f"Model versions {', '.join(sorted(removed))} removed")
@@ -0,0 +1,70 @@
+import glob
+import os
+
+import numpy as np
+from PIL import Image
+
+# shared image preprocessing for the flask api, the sagemaker client and offline batch jobs.
+# images are decoded and resized as uint8 and only converted to float and scaled to [0, 1]
+# once per batch, right before they go to the model.
+
+IMG_SIZE = 250
+
+def load_image(fp, img_size=IMG_SIZE, draft=True):
+    # fp is a path or file-like object holding png/jpg bytes, returns an
+    # (img_size, img_size, 3) uint8 array resized the same way keras' load_img does
+    img = Image.open(fp)
+    if draft:
+        # jpegs can be decoded at a reduced scale that is still at least img_size, which
+        # is much cheaper than decoding at full size and throwing most of it away.
+        # other formats ignore this.
+        img.draft('RGB', (img_size, img_size))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    if img.size != (img_size, img_size):
+        img = img.resize((img_size, img_size), Image.NEAREST)
+    return np.asarray(img, dtype=np.uint8)
+
+def normalize(images, out=None):
+    # scale a uint8 batch to float32 in [0, 1] in one pass
+    return np.divide(images, np.float32(255), out=out, dtype=np.float32)
+
+def preprocess_image(fp, img_size=IMG_SIZE):
+    # a single image as a model ready (1, img_size, img_size, 3) float32 batch
+    return normalize(load_image(fp, img_size)[np.newaxis])
+
+def load_test_set(data_dir, img_size=IMG_SIZE):
+    # every png of a directory with one sub directory per class as a normalized batch and
+    # its labels. labels follow flow_from_directory: sub directories in sorted order, so
+    # meme = 0, chart = 1
+    classes = sorted(os.listdir(data_dir))
+    paths, labels = [], []
+    for label, cls in enumerate(classes):
+        for path in sorted(glob.glob(os.path.join(data_dir, cls, '*.png'))):
+            paths.append(path)
+            labels.append(label)
+    buffer = BatchBuffer(len(paths), img_size)
+    for i, path in enumerate(paths):
+        buffer.fill(i, path)
+    return buffer.normalize(), np.array(labels)
+
+
+class BatchBuffer(object):
+    # preallocated uint8 and float32 batches that images are decoded straight into, so a
+    # batch costs no allocations after the first one. not thread safe, but separate rows
+    # can be filled from separate threads.
+
+    def __init__(self, batch_size, img_size=IMG_SIZE):
+        self.batch_size = batch_size
+        self.img_size = img_size
+        self.images = np.zeros((batch_size, img_size, img_size, 3), dtype=np.uint8)
+        self._normalized = np.empty(self.images.shape, dtype=np.float32)
+
+    def fill(self, i, fp):
+        self.images[i] = load_image(fp, self.img_size)
+
+    def normalize(self, n=None):
+        # returns a view of the first n rows of the normalized batch, it is overwritten by
+        # the next call
+        n = self.batch_size if n is None else n
+        return normalize(self.images[:n], out=self._normalized[:n])
@@ -1,27 +1,134 @@
 import argparse
 import base64
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# defining the api-endpoint, can be overridden with ML_API_ENDPOINT or --endpoint
+API_ENDPOINT = os.environ.get('ML_API_ENDPOINT') or "http://a65eff3536cd311e99e6e1690e200b1c-1510142545.us-east-1.elb.amazonaws.com:5000/chart_classifier/predict"
 
-# defining the api-endpoint
-API_ENDPOINT = "http://a65eff3536cd311e99e6e1690e200b1c-1510142545.us-east-1.elb.amazonaws.com:5000/chart_classifier/predict"
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
 
-# taking input image via command line
+# taking input images via command line, a single image, a directory or a file list
 ap = argparse.ArgumentParser()
-ap.add_argument("-i", "--image", required=True,
-                help="path of the image")
+source = ap.add_mutually_exclusive_group(required=True)
+source.add_argument("-i", "--image",
+                    help="path of the image")
+source.add_argument("-d", "--dir",
+                    help="directory of images to classify, searched recursively")
+source.add_argument("-f", "--file_list",
+                    help="text file with one image path per line")
+ap.add_argument("-e", "--endpoint", default=API_ENDPOINT,
+                help="url of the predict endpoint")
+ap.add_argument("-o", "--output", default=None,
+                help="file to stream results to, .csv or .jsonl, defaults to jsonl on stdout")
+ap.add_argument("-c", "--concurrency", type=int, default=8,
+                help="requests kept in flight")
+ap.add_argument("--retries", type=int, default=3,
+                help="retries for connection errors and 429/5xx responses")
+ap.add_argument("--backoff", type=float, default=0.5,
+                help="backoff factor between retries, sleeps backoff * 2^(retry - 1) seconds")
+ap.add_argument("--timeout", type=float, default=30,
+                help="request timeout in seconds")
+ap.add_argument("--base64", action="store_true",
+                help="send the image base64 encoded in a form field instead of as raw bytes")
 args = vars(ap.parse_args())
 
-image_path = args['image']
-b64_image = ""
-# Encoding the JPG,PNG,etc. image to base64 format
-with open(image_path, "rb") as imageFile:
-    b64_image = base64.b64encode(imageFile.read())
+def list_images():
+    if args['image']:
+        return [args['image']]
+    if args['file_list']:
+        with open(args['file_list']) as f:
+            return [line.strip() for line in f if line.strip()]
+    paths = []
+    for root, _, files in os.walk(args['dir']):
+        paths.extend(os.path.join(root, name) for name in sorted(files)
+                     if name.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(paths)
+
+def make_session(concurrency, retries, backoff):
+    # one pooled keep-alive connection per worker thread. POST is not retried by default
+    # since it is not idempotent in general, but predictions are, so we opt in.
+    retry_kwargs = dict(total=retries, backoff_factor=backoff, status_forcelist=(429, 500, 502, 503, 504),
+                        raise_on_status=False)
+    try:
+        retry = Retry(allowed_methods=frozenset(['POST']), **retry_kwargs)
+    except TypeError:
+        # urllib3 < 1.26 calls it method_whitelist
+        retry = Retry(method_whitelist=frozenset(['POST']), **retry_kwargs)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def classify(session, image_path):
+    start = time.time()
+    result = {'image': image_path}
+    try:
+        with open(image_path, "rb") as imageFile:
+            image_bytes = imageFile.read()
+        if args['base64']:
+            # Encoding the JPG,PNG,etc. image to base64 format, for older versions of the api
+            r = session.post(url=args['endpoint'], data={'encoded_image': base64.b64encode(image_bytes)},
+                             timeout=args['timeout'])
+        else:
+            # sending the raw image bytes is about a third smaller and skips decoding on the server
+            r = session.post(url=args['endpoint'], data=image_bytes, timeout=args['timeout'],
+                             headers={'Content-Type': 'application/octet-stream'})
+        r.raise_for_status()
+        result.update(r.json())
+    except (OSError, ValueError, requests.RequestException) as e:
+        result['error'] = str(e)
+    result['latency_ms'] = round(1000 * (time.time() - start), 1)
+    return result
+
+class ResultWriter(object):
+    # writes each result as soon as it comes back, so a long run can be followed and a
+    # crash does not lose what was already classified
+
+    FIELDS = ['image', 'class', 'probability', 'error', 'latency_ms']
+
+    def __init__(self, output):
+        self.file = open(output, 'w', newline='') if output else sys.stdout
+        self.csv = None
+        if output and output.endswith('.csv'):
+            self.csv = csv.DictWriter(self.file, fieldnames=self.FIELDS, extrasaction='ignore')
+            self.csv.writeheader()
+
+    def write(self, result):
+        if self.csv is not None:
+            self.csv.writerow(result)
+        else:
+            self.file.write(json.dumps(result) + '\n')
+        self.file.flush()
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
 
-# data to be sent to api
-data = {'encoded_image': b64_image}
+image_paths = list_images()
+session = make_session(args['concurrency'], args['retries'], args['backoff'])
+writer = ResultWriter(args['output'])
 
-# sending post request and saving response as response object
-r = requests.post(url=API_ENDPOINT, data=data)
+start = time.time()
+n_errors = 0
+with ThreadPoolExecutor(max_workers=args['concurrency']) as pool:
+    futures = [pool.submit(classify, session, path) for path in image_paths]
+    for future in as_completed(futures):
+        result = future.result()
+        n_errors += 'error' in result
+        writer.write(result)
+writer.close()
 
-# extracting the response
-print(r.content)
\ No newline at end of file
+# throughput summary goes to stderr so it does not mix with results on stdout
+elapsed = time.time() - start
+print(f"classified {len(image_paths) - n_errors}/{len(image_paths)} images in {elapsed:.1f}s "
+      f"({len(image_paths) / elapsed:.1f} images/s, {n_errors} errors)", file=sys.stderr)
@@ -0,0 +1,72 @@
+import argparse
+import base64
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+
+# the benchmarks drive the api code directly, so make it importable from here
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api')
+sys.path.insert(0, API_DIR)
+
+# compares per-request latency of /chart_classifier/predict when the model is loaded on
+# every request (how the api used to work) against the shared per-process model holder
+
+ap = argparse.ArgumentParser()
+ap.add_argument("-d", "--data_dir", default=os.path.join(API_DIR, '..', 'data', 'test'),
+                help="directory of test images, searched recursively")
+ap.add_argument("-m", "--model", default=os.path.join(API_DIR, 'cv_chart_model.h5'),
+                help="path of the keras model")
+ap.add_argument("-n", "--n_requests", type=int, default=50,
+                help="number of requests to send in each mode")
+args = vars(ap.parse_args())
+
+# app builds its model registry from MODEL_PATH on import, so it has to point at --model
+# first. repeated images would be answered from the prediction cache, which measures
+# neither model loading nor inference, and the micro-batcher would hold every one of these
+# sequential requests for BATCH_MAX_WAIT_MS before running it
+os.environ['MODEL_PATH'] = os.path.abspath(args['model'])
+os.environ['CACHE_MAX_ENTRIES'] = '0'
+os.environ['BATCH_MAX_SIZE'] = '1'
+
+import app as api
+from model_registry import ModelRegistry
+
+def load_images(data_dir, n):
+    paths = sorted(glob.glob(os.path.join(data_dir, '**', '*.png'), recursive=True))[:n]
+    images = []
+    for path in paths:
+        with open(path, "rb") as f:
+            images.append(base64.b64encode(f.read()))
+    return images
+
+def run(client, images, reload_every_request):
+    latencies = []
+    for b64_image in images:
+        if reload_every_request:
+            api.model_registry = ModelRegistry(model_path=args['model'], poll_seconds=0)
+        start = time.time()
+        r = client.post('/chart_classifier/predict', data={'encoded_image': b64_image})
+        latencies.append(time.time() - start)
+        assert r.status_code == 200, r.data
+    return np.array(latencies) * 1000
+
+def summarize(name, latencies):
+    print(f"{name:<22} mean {latencies.mean():8.1f}ms  p50 {np.percentile(latencies, 50):8.1f}ms  "
+          f"p95 {np.percentile(latencies, 95):8.1f}ms  throughput {1000 / latencies.mean():6.1f} req/s")
+
+images = load_images(args['data_dir'], args['n_requests'])
+client = api.app.test_client()
+
+before = run(client, images, reload_every_request=True)
+
+# the shared registry pays the load once, on the first request, like a fresh worker would
+api.model_registry = ModelRegistry(model_path=args['model'], poll_seconds=0)
+after = run(client, images, reload_every_request=False)
+
+print(f"{len(images)} requests per mode")
+summarize("load per request", before)
+summarize("shared model holder", after)
+print(f"speedup (mean latency): {before.mean() / after.mean():.1f}x")
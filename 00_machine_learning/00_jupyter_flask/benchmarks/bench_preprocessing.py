@@ -0,0 +1,85 @@
+import argparse
+import glob
+import os
+import sys
+import time
+from io import BytesIO
+
+import numpy as np
+from tensorflow.keras.preprocessing import image
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api')
+sys.path.insert(0, API_DIR)
+
+from preprocessing import BatchBuffer, load_image, normalize
+
+# compares the original keras based decode_image against the shared preprocessing module,
+# one image at a time and decoding into a preallocated batch buffer
+
+ap = argparse.ArgumentParser()
+ap.add_argument("-d", "--data_dir", default=os.path.join(API_DIR, '..', 'data', 'test'),
+                help="directory of test images, searched recursively")
+ap.add_argument("-b", "--batch_size", type=int, default=32,
+                help="batch size for the batched pipeline")
+ap.add_argument("-r", "--repeats", type=int, default=3,
+                help="passes over the images, the fastest one is reported")
+args = vars(ap.parse_args())
+
+# the decode_image function the api used before the preprocessing module
+def legacy_decode_image(fp):
+    img = image.img_to_array(image.load_img(fp, target_size=(250, 250))) / 255
+    img = np.expand_dims(img, axis=0)
+    return img
+
+def single(fp):
+    return normalize(load_image(fp)[np.newaxis])
+
+def run_single(fn, images):
+    return [fn(BytesIO(b)) for b in images]
+
+def run_batched(images, batch_size, keep=False):
+    # the normalized batch is a view into the buffer, it is only copied out when the
+    # results are kept for comparison
+    buffer = BatchBuffer(batch_size)
+    out = []
+    for start in range(0, len(images), batch_size):
+        chunk = images[start:start + batch_size]
+        for i, b in enumerate(chunk):
+            buffer.fill(i, BytesIO(b))
+        batch = buffer.normalize(len(chunk))
+        if keep:
+            out.append(batch.copy())
+    return out
+
+def best_time(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        result = fn()
+        times.append(time.time() - start)
+    return min(times), result
+
+paths = sorted(glob.glob(os.path.join(args['data_dir'], '**', '*.png'), recursive=True) +
+               glob.glob(os.path.join(args['data_dir'], '**', '*.jp*g'), recursive=True))
+images = []
+for path in paths:
+    with open(path, "rb") as f:
+        images.append(f.read())
+
+legacy_time, legacy = best_time(lambda: run_single(legacy_decode_image, images), args['repeats'])
+single_time, new = best_time(lambda: run_single(single, images), args['repeats'])
+batched_time, _ = best_time(lambda: run_batched(images, args['batch_size']), args['repeats'])
+batched = run_batched(images, args['batch_size'], keep=True)
+
+# the pipelines should produce the same model inputs for pngs, jpegs can differ slightly
+# because of the reduced size decode
+legacy = np.concatenate(legacy)
+max_diff = max(np.abs(legacy - np.concatenate(new)).max(), np.abs(legacy - np.concatenate(batched)).max())
+
+n = len(images)
+print(f"{n} images from {args['data_dir']}")
+for name, t in [("legacy decode_image", legacy_time),
+                ("preprocessing, single", single_time),
+                (f"preprocessing, batch {args['batch_size']}", batched_time)]:
+    print(f"{name:<28} {1000 * t / n:7.2f}ms/image  {n / t:8.1f} images/s  {legacy_time / t:5.2f}x")
+print(f"max abs difference from legacy: {max_diff:.6f}")
@@ -0,0 +1,88 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api')
+sys.path.insert(0, API_DIR)
+
+from backends import backend_path, build_backend
+from preprocessing import load_test_set
+
+# reports what the model cascade (CASCADE_MODEL_PATH in app.py) buys on the test set: the
+# fraction of images escalated to the full model, cascade accuracy next to each model on
+# its own, and the average per image latency of the cascade against the full model alone.
+# the small model comes from 01_sagemaker/train.py --train_cascade 1.
+
+ap = argparse.ArgumentParser()
+ap.add_argument("-d", "--data_dir", default=os.path.join(API_DIR, '..', 'data', 'test'),
+                help="test directory with one sub directory per class, 00_meme and 01_chart")
+ap.add_argument("-m", "--model", default=os.path.join(API_DIR, 'cv_chart_model.h5'),
+                help="path of the full keras model")
+ap.add_argument("-s", "--small_model", default=os.path.join(API_DIR, 'cv_chart_model_small.h5'),
+                help="path of the small keras model")
+ap.add_argument("-b", "--backend", default='keras',
+                help="keras, tflite or tflite_int8, run api/export_model.py on both models first for tflite")
+ap.add_argument("--low", type=float, default=0.2,
+                help="images the small model gives a probability above this and below --high are escalated")
+ap.add_argument("--high", type=float, default=0.8)
+ap.add_argument("-o", "--output", default='cascade_report.json',
+                help="where to write the report")
+
+def per_image_ms(backend, images):
+    # one image at a time, the way the predict endpoint sees traffic without batching
+    backend.predict(images[:1])
+    times = []
+    for i in range(len(images)):
+        start = time.perf_counter()
+        backend.predict(images[i:i + 1])
+        times.append(time.perf_counter() - start)
+    return 1000 * np.array(times)
+
+def load(model_path, name):
+    with open(backend_path(model_path, name), 'rb') as f:
+        return build_backend(name, f.read())
+
+if __name__ == '__main__':
+    args = vars(ap.parse_args())
+    full, small = load(args['model'], args['backend']), load(args['small_model'], args['backend'])
+    images, labels = load_test_set(args['data_dir'], full.input_shape[1])
+
+    full_ms = per_image_ms(full, images)
+    small_ms = per_image_ms(small, images)
+    full_probs = np.concatenate([full.predict(images[i:i + 32]) for i in range(0, len(images), 32)])[:, 0]
+    small_probs = np.concatenate([small.predict(images[i:i + 32]) for i in range(0, len(images), 32)])[:, 0]
+
+    escalated = (small_probs > args['low']) & (small_probs < args['high'])
+    cascade_probs = np.where(escalated, full_probs, small_probs)
+    # every image pays for the small model, escalated ones for the full model as well
+    cascade_ms = small_ms + np.where(escalated, full_ms, 0)
+
+    report = {
+        'data_dir': args['data_dir'], 'backend': args['backend'], 'n_images': len(labels), 'band': [args['low'], args['high']],
+        'escalated_fraction': float(escalated.mean()),
+        'accuracy': {
+            'full': float(np.mean((full_probs > .5) == labels)),
+            'small': float(np.mean((small_probs > .5) == labels)),
+            'cascade': float(np.mean((cascade_probs > .5) == labels)),
+        },
+        'mean_latency_ms': {
+            'full': float(full_ms.mean()),
+            'small': float(small_ms.mean()),
+            'cascade': float(cascade_ms.mean()),
+        },
+        'latency_saved_ms': float(full_ms.mean() - cascade_ms.mean()),
+    }
+    with open(args['output'], 'w') as f:
+        json.dump(report, f, indent=2)
+
+    acc, lat = report['accuracy'], report['mean_latency_ms']
+    print(f"{100 * report['escalated_fraction']:.1f}% of {len(labels)} test images escalated "
+          f"with band ({args['low']}, {args['high']})")
+    print(f"accuracy    full {acc['full']:.3f}  small {acc['small']:.3f}  cascade {acc['cascade']:.3f}")
+    print(f"latency ms  full {lat['full']:.2f}  small {lat['small']:.2f}  cascade {lat['cascade']:.2f}  "
+          f"saved {report['latency_saved_ms']:.2f} per image")
+    print(f"report written to {args['output']}")
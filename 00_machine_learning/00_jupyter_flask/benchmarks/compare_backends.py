@@ -0,0 +1,83 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api')
+sys.path.insert(0, API_DIR)
+
+from backends import BACKENDS, backend_path, build_backend
+from preprocessing import load_test_set
+
+# compares every exported backend of the chart classifier on the test set: accuracy,
+# agreement with the keras model, single image and batched latency and file size.
+# run api/export_model.py first to write the tflite models.
+
+ap = argparse.ArgumentParser()
+ap.add_argument("-d", "--data_dir", default=os.path.join(API_DIR, '..', 'data', 'test'),
+                help="test directory with one sub directory per class, 00_meme and 01_chart")
+ap.add_argument("-m", "--model", default=os.path.join(API_DIR, 'cv_chart_model.h5'),
+                help="path of the keras model, exports are looked up next to it")
+ap.add_argument("-b", "--batch_size", type=int, default=32,
+                help="batch size for the batched latency")
+ap.add_argument("-o", "--output", default='backend_report.json',
+                help="where to write the report")
+args = vars(ap.parse_args())
+
+def predict_all(backend, images, batch_size):
+    return np.concatenate([backend.predict(images[i:i + batch_size])
+                           for i in range(0, len(images), batch_size)])[:, 0]
+
+def latency_ms(backend, images, batch_size, n_runs):
+    # median over n_runs after one warmup call, per image
+    batch = images[:batch_size]
+    backend.predict(batch)
+    times = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        backend.predict(batch)
+        times.append(time.perf_counter() - start)
+    return 1000 * np.median(times) / len(batch)
+
+available = [name for name in BACKENDS if os.path.exists(backend_path(args['model'], name))]
+results = []
+keras_probs = None
+for name in available:
+    path = backend_path(args['model'], name)
+    with open(path, 'rb') as f:
+        model_bytes = f.read()
+
+    start = time.perf_counter()
+    backend = build_backend(name, model_bytes)
+    load_time = time.perf_counter() - start
+
+    images, labels = load_test_set(args['data_dir'], backend.input_shape[1])
+    probs = predict_all(backend, images, args['batch_size'])
+    if name == 'keras':
+        keras_probs = probs
+
+    results.append({
+        'backend': name,
+        'size_mb': len(model_bytes) / 1e6,
+        'load_seconds': load_time,
+        'accuracy': float(np.mean((probs > .5) == labels)),
+        'agreement_with_keras': float(np.mean((probs > .5) == (keras_probs > .5))) if keras_probs is not None else None,
+        'max_prob_diff_from_keras': float(np.abs(probs - keras_probs).max()) if keras_probs is not None else None,
+        'single_ms_per_image': latency_ms(backend, images, 1, 50),
+        'batched_ms_per_image': latency_ms(backend, images, args['batch_size'], 10),
+    })
+
+with open(args['output'], 'w') as f:
+    json.dump({'data_dir': args['data_dir'], 'n_images': len(labels), 'batch_size': args['batch_size'],
+               'results': results}, f, indent=2)
+
+print(f"| backend | size (MB) | load (s) | accuracy | agrees with keras | single (ms/img) | batch {args['batch_size']} (ms/img) |")
+print("| --- | --- | --- | --- | --- | --- | --- |")
+for r in results:
+    agreement = f"{r['agreement_with_keras']:.3f}" if r['agreement_with_keras'] is not None else "-"
+    print(f"| {r['backend']} | {r['size_mb']:.1f} | {r['load_seconds']:.2f} | {r['accuracy']:.3f} | {agreement} | "
+          f"{r['single_ms_per_image']:.2f} | {r['batched_ms_per_image']:.2f} |")
+print(f"report written to {args['output']}")
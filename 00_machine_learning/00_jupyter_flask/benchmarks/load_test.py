@@ -0,0 +1,180 @@
+import argparse
+import base64
+import glob
+import itertools
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+# load test for the chart classifier api. replays the test images against a running
+# instance, either holding a fixed number of requests in flight (closed loop) or sending
+# at a fixed rate regardless of how fast responses come back (open loop), and writes the
+# results as json so runs can be compared.
+#
+#   python benchmarks/load_test.py --concurrency 8 --duration 30
+#   python benchmarks/load_test.py --rate 20 --duration 30 --label batching-on
+
+ap = argparse.ArgumentParser()
+ap.add_argument("-u", "--url", default="http://localhost:5000/chart_classifier/predict",
+                help="endpoint to load test")
+ap.add_argument("-d", "--data_dir",
+                default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'test'),
+                help="directory of images to replay, searched recursively")
+ap.add_argument("-c", "--concurrency", type=int, default=4,
+                help="closed loop: requests kept in flight")
+ap.add_argument("-r", "--rate", type=float, default=None,
+                help="open loop: requests per second, overrides --concurrency")
+ap.add_argument("--max_in_flight", type=int, default=256,
+                help="open loop: most outstanding requests before sends are counted as dropped")
+ap.add_argument("-t", "--duration", type=float, default=30,
+                help="seconds to send requests for")
+ap.add_argument("--warmup", type=float, default=3,
+                help="seconds of traffic at the start that are left out of the results")
+ap.add_argument("-f", "--format", choices=['raw', 'multipart', 'base64'], default='raw',
+                help="how images are uploaded")
+ap.add_argument("--timeout", type=float, default=30,
+                help="request timeout in seconds")
+ap.add_argument("-l", "--label", default='',
+                help="free text stored with the results, e.g. the serving change under test")
+ap.add_argument("-o", "--output", default=None,
+                help="json file to write results to, defaults to load_test_<time>.json")
+args = vars(ap.parse_args())
+
+def load_images(data_dir):
+    paths = sorted(glob.glob(os.path.join(data_dir, '**', '*.png'), recursive=True) +
+                   glob.glob(os.path.join(data_dir, '**', '*.jp*g'), recursive=True))
+    images = []
+    for path in paths:
+        with open(path, "rb") as f:
+            images.append(f.read())
+    return images
+
+def make_request_kwargs(image_bytes, fmt):
+    if fmt == 'raw':
+        return {'data': image_bytes, 'headers': {'Content-Type': 'application/octet-stream'}}
+    if fmt == 'multipart':
+        return {'files': {'image': ('image.png', image_bytes)}}
+    return {'data': {'encoded_image': base64.b64encode(image_bytes)}}
+
+# one keep-alive session per sending thread
+local = threading.local()
+
+def get_session():
+    if not hasattr(local, 'session'):
+        local.session = requests.Session()
+    return local.session
+
+def send(payload, scheduled_at):
+    # latency is measured from when the request was due to go out, so in open loop mode
+    # time spent waiting for a free thread counts against the server, not hidden by it
+    try:
+        r = get_session().post(args['url'], timeout=args['timeout'], **payload)
+        ok = r.status_code == 200
+        status = r.status_code
+    except requests.RequestException as e:
+        ok = False
+        status = type(e).__name__
+    return scheduled_at, time.perf_counter(), ok, status
+
+def run_closed_loop(payloads, concurrency, duration):
+    results = []
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + duration
+    payload_iter = itertools.cycle(payloads)
+
+    def worker():
+        while True:
+            now = time.perf_counter()
+            if now >= stop_at:
+                return
+            with lock:
+                payload = next(payload_iter)
+            result = send(payload, now)
+            with lock:
+                results.append(result)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, 0
+
+def run_open_loop(payloads, rate, duration, max_in_flight):
+    futures = []
+    dropped = 0
+    in_flight = threading.BoundedSemaphore(max_in_flight)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        for i, payload in enumerate(itertools.cycle(payloads)):
+            scheduled_at = start + i / rate
+            if scheduled_at - start >= duration:
+                break
+            delay = scheduled_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            # a server that cannot keep up should show up as errors, not as a client that
+            # quietly slows down its send rate
+            if not in_flight.acquire(blocking=False):
+                dropped += 1
+                continue
+            future = pool.submit(send, payload, scheduled_at)
+            future.add_done_callback(lambda _: in_flight.release())
+            futures.append(future)
+    return [f.result() for f in futures], dropped
+
+def summarize(results, dropped, started_at, warmup):
+    measured = [r for r in results if r[0] - started_at >= warmup]
+    if not measured:
+        raise SystemExit("no requests completed after the warmup period")
+    latencies = np.array([(done - scheduled) * 1000 for scheduled, done, _, _ in measured])
+    ok = np.array([r[2] for r in measured])
+    window = max(r[1] for r in measured) - min(r[0] for r in measured)
+    statuses = {}
+    for r in measured:
+        statuses[str(r[3])] = statuses.get(str(r[3]), 0) + 1
+    return {
+        'requests': len(measured),
+        'dropped': dropped,
+        'throughput_rps': float(ok.sum() / window),
+        'error_rate': float(1 - ok.mean()),
+        'latency_ms': {
+            'mean': float(latencies.mean()),
+            'p50': float(np.percentile(latencies, 50)),
+            'p95': float(np.percentile(latencies, 95)),
+            'p99': float(np.percentile(latencies, 99)),
+            'max': float(latencies.max()),
+        },
+        'statuses': statuses,
+    }
+
+if __name__ == '__main__':
+    images = load_images(args['data_dir'])
+    payloads = [make_request_kwargs(image_bytes, args['format']) for image_bytes in images]
+    mode = 'open_loop' if args['rate'] else 'closed_loop'
+
+    print(f"{mode} load test of {args['url']} with {len(images)} images for {args['duration']}s")
+    started_at = time.perf_counter()
+    if mode == 'open_loop':
+        results, dropped = run_open_loop(payloads, args['rate'], args['duration'], args['max_in_flight'])
+    else:
+        results, dropped = run_closed_loop(payloads, args['concurrency'], args['duration'])
+
+    summary = summarize(results, dropped, started_at, args['warmup'])
+    report = {'label': args['label'], 'mode': mode, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'config': {k: v for k, v in args.items() if k != 'output'}, 'results': summary}
+
+    output = args['output'] or f"load_test_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    lat = summary['latency_ms']
+    print(f"requests {summary['requests']}  dropped {summary['dropped']}  "
+          f"throughput {summary['throughput_rps']:.1f} req/s  error rate {100 * summary['error_rate']:.2f}%")
+    print(f"latency ms  p50 {lat['p50']:.1f}  p95 {lat['p95']:.1f}  p99 {lat['p99']:.1f}  max {lat['max']:.1f}")
+    print(f"results written to {output}")
@@ -0,0 +1,93 @@
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from sweep import DATA_DIR, TRAIN_SCRIPT, to_args
+
+# scaling benchmark for data parallel training (train.py --distributed 1). trains the same
+# model with 1, 2, ... --max_processes horovod processes on this machine and reports the
+# training images/sec of each run, the speedup over one process and the scaling efficiency.
+#
+#   python bench_data_parallel.py --max_processes 4 --epochs 3
+#   python bench_data_parallel.py --data_format shards --train shards/train --test shards/test
+#
+# the processes split the CPUs evenly, so the runs compare one process using all cores with
+# several processes using a share each. arguments this script does not know, like --epochs
+# above, are passed on to train.py.
+
+ap = argparse.ArgumentParser()
+ap.add_argument("--base", default='hyperparameters.json',
+                help="hyperparameters every run starts from")
+ap.add_argument("--train", default=os.path.join(DATA_DIR, 'train'))
+ap.add_argument("--test", default=os.path.join(DATA_DIR, 'test'))
+ap.add_argument("-n", "--max_processes", type=int, default=multiprocessing.cpu_count(),
+                help="runs with 1 to this many processes")
+ap.add_argument("--launcher", default='horovodrun', choices=['horovodrun', 'mpirun'])
+ap.add_argument("-o", "--output_dir", default='scaling',
+                help="one sub directory per run and the report go here")
+
+def launch_command(launcher, n):
+    if launcher == 'mpirun':
+        # no core binding, TF's thread pools are sized by train.py instead
+        return ['mpirun', '-np', str(n), '--bind-to', 'none', '--allow-run-as-root', '-x', 'OMP_NUM_THREADS']
+    return ['horovodrun', '--gloo', '-np', str(n), '-H', f'localhost:{n}']
+
+def steady_images_per_sec(report):
+    # throughput without the first epoch, which also builds the graph
+    epochs = report['epochs']['model']
+    steady = epochs[1:] or epochs
+    return float(np.mean([e['images_per_sec'] for e in steady])), float(np.mean([e['step_time_ms'] for e in steady]))
+
+if __name__ == '__main__':
+    args, passthrough = ap.parse_known_args()
+    args = vars(args)
+    with open(args['base']) as f:
+        base = json.load(f)
+
+    cpus = multiprocessing.cpu_count()
+    runs = []
+    for n in range(1, args['max_processes'] + 1):
+        run_dir = os.path.join(args['output_dir'], f'processes_{n}')
+        os.makedirs(run_dir, exist_ok=True)
+        threads = max(1, cpus // n)
+        command = launch_command(args['launcher'], n) + [sys.executable, TRAIN_SCRIPT] + to_args(base) + [
+            '--train_cascade', '0', '--distributed', '1'] + passthrough + [
+            '--model_dir', run_dir, '--train', args['train'], '--test', args['test'],
+            '--intra_op_threads', str(threads), '--inter_op_threads', '1']
+        env = dict(os.environ, OMP_NUM_THREADS=str(threads))
+        print(f"training with {n} processes, {threads} threads each")
+        start = time.time()
+        with open(os.path.join(run_dir, 'train.log'), 'w') as log:
+            returncode = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT, env=env)
+        if returncode != 0:
+            print(f"run with {n} processes failed, see {os.path.join(run_dir, 'train.log')}")
+            continue
+        with open(os.path.join(run_dir, 'training_report.json')) as f:
+            images_per_sec, step_time_ms = steady_images_per_sec(json.load(f))
+        with open(os.path.join(run_dir, 'model_report.json')) as f:
+            val_accuracy = json.load(f)['model']['val_accuracy']
+        runs.append({'processes': n, 'threads_per_process': threads, 'images_per_sec': images_per_sec,
+                     'step_time_ms': step_time_ms, 'val_accuracy': val_accuracy, 'seconds': time.time() - start})
+
+    if not runs:
+        sys.exit("no run finished")
+    # relative to the run with the fewest processes that finished
+    for run in runs:
+        run['speedup'] = run['images_per_sec'] / runs[0]['images_per_sec']
+        run['efficiency'] = run['speedup'] * runs[0]['processes'] / run['processes']
+    path = os.path.join(args['output_dir'], 'scaling_report.json')
+    with open(path, 'w') as f:
+        json.dump({'cpus': cpus, 'launcher': args['launcher'], 'runs': runs}, f, indent=2)
+
+    print(f"report written to {path}")
+    print("| processes | threads each | images/s | step (ms) | speedup | efficiency | val accuracy |")
+    print("| --- | --- | --- | --- | --- | --- | --- |")
+    for r in runs:
+        print(f"| {r['processes']} | {r['threads_per_process']} | {r['images_per_sec']:.1f} | {r['step_time_ms']:.0f} | "
+              f"{r['speedup']:.2f}x | {100 * r['efficiency']:.0f}% | {r['val_accuracy']:.3f} |")
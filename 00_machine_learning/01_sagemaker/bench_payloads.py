@@ -0,0 +1,99 @@
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+
+import numpy as np
+
+from request import CONTENT_TYPES, invoke, make_payload, sagemaker_client
+
+# compares the request formats of request.py end to end against local_endpoint.py: payload
+# size, and the latency of building the payload, sending it and getting the prediction back.
+#
+#   python bench_payloads.py -m model/cv_chart_model.h5 -d ../00_jupyter_flask/data/test
+#
+# starts the stand-in endpoint itself unless --endpoint_url points at a running one.
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '00_jupyter_flask', 'data', 'test')
+LOCAL_ENDPOINT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'local_endpoint.py')
+
+ap = argparse.ArgumentParser()
+ap.add_argument("-m", "--model", default=os.path.join('model', 'cv_chart_model.h5'),
+                help="keras model for the stand-in endpoint")
+ap.add_argument("-d", "--data_dir", default=DATA_DIR,
+                help="images to send, searched recursively")
+ap.add_argument("-n", "--n_images", type=int, default=50)
+ap.add_argument("--port", type=int, default=8080)
+ap.add_argument("--bandwidth_mbps", type=float, default=0,
+                help="upload bandwidth the stand-in simulates, 0 for loopback speed")
+ap.add_argument("--endpoint_url", default=None,
+                help="url of a running stand-in endpoint")
+ap.add_argument("-o", "--output", default='payload_report.json')
+
+def wait_until_up(url, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url + '/ping')
+            return
+        except OSError:
+            time.sleep(.5)
+    raise RuntimeError(f"endpoint at {url} did not come up")
+
+def bench(sage, paths, fmt):
+    # one request per image, the way request.py sends them
+    sizes, times, probs = [], [], []
+    for path in paths:
+        start = time.perf_counter()
+        payload, content_type = make_payload(path, fmt)
+        probs.append(invoke(sage, 'local', payload, content_type)[0][0])
+        times.append(time.perf_counter() - start)
+        sizes.append(len(payload))
+    return {'format': fmt, 'content_type': CONTENT_TYPES[fmt],
+            'mean_payload_kb': float(np.mean(sizes)) / 1024,
+            'median_latency_ms': 1000 * float(np.median(times)),
+            'p95_latency_ms': 1000 * float(np.percentile(times, 95))}, np.array(probs)
+
+if __name__ == '__main__':
+    args = vars(ap.parse_args())
+    paths = sorted(glob.glob(os.path.join(args['data_dir'], '**', '*.png'), recursive=True))[:args['n_images']]
+
+    server = None
+    url = args['endpoint_url']
+    if url is None:
+        url = f"http://localhost:{args['port']}"
+        server = subprocess.Popen([sys.executable, LOCAL_ENDPOINT, '-m', args['model'], '-p', str(args['port']),
+                                   '--bandwidth_mbps', str(args['bandwidth_mbps'])], stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(url)
+        sage = sagemaker_client(url)
+        # one request first, so the stand-in has built its graph before anything is timed
+        invoke(sage, 'local', *make_payload(paths[0], 'npy'))
+        results = {}
+        for fmt in CONTENT_TYPES:
+            results[fmt] = bench(sage, paths, fmt)
+    finally:
+        if server is not None:
+            server.terminate()
+
+    # the formats have to agree, up to float rounding
+    baseline_probs = results['json'][1]
+    report = {'n_images': len(paths), 'bandwidth_mbps': args['bandwidth_mbps'], 'formats': []}
+    for fmt, (row, probs) in results.items():
+        row['max_prob_difference'] = float(np.max(np.abs(probs - baseline_probs)))
+        row['payload_reduction'] = 1 - row['mean_payload_kb'] / results['json'][0]['mean_payload_kb']
+        row['latency_reduction'] = 1 - row['median_latency_ms'] / results['json'][0]['median_latency_ms']
+        report['formats'].append(row)
+    with open(args['output'], 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f"{len(paths)} images, report written to {args['output']}")
+    print("| format | content type | payload (KB) | median latency (ms) | p95 latency (ms) | payload vs json | latency vs json |")
+    print("| --- | --- | --- | --- | --- | --- | --- |")
+    for r in report['formats']:
+        print(f"| {r['format']} | `{r['content_type']}` | {r['mean_payload_kb']:.1f} | {r['median_latency_ms']:.1f} | "
+              f"{r['p95_latency_ms']:.1f} | {-100 * r['payload_reduction']:+.0f}% | {-100 * r['latency_reduction']:+.0f}% |")
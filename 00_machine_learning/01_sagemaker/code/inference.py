@@ -0,0 +1,121 @@
+import io
+import json
+import os
+import threading
+
+import grpc
+import numpy as np
+import requests
+from PIL import Image
+from tensorflow.core.framework import tensor_pb2, tensor_shape_pb2, types_pb2
+from tensorflow_serving.apis import get_model_metadata_pb2, predict_pb2, prediction_service_pb2_grpc
+
+# request handler for the SageMaker TensorFlow Serving endpoint. the container runs it in
+# front of TF Serving. clients can send compact payloads instead of a json float array:
+#
+#   application/json     {"instances": [...]} as TF Serving takes it, passed on to its
+#                        REST API unchanged
+#   application/x-npy    uint8 (n, img_size, img_size, 3) array in .npy format
+#   application/x-image  the bytes of one png or jpeg image, also image/png and image/jpeg
+#   application/x-npz    several png or jpeg images, the bytes of each one as a uint8 array
+#                        in an .npz archive, in order: arr_0, arr_1, ...
+#
+# the compact formats are decoded and scaled to [0, 1] here and sent to TF Serving over
+# gRPC as one float32 tensor, so neither side writes or parses the pixels as text. the
+# response is the json TF Serving's REST API answers with, {"predictions": [...]}.
+#
+# sage_train_and_deploy.py adds this directory to the model archive as code/, and the
+# container installs requirements.txt next to it.
+
+# resolution raw images are resized to, the model's input size
+IMG_SIZE = int(os.environ.get('IMG_SIZE') or 250)
+# longest a gRPC call to TF Serving may take
+GRPC_TIMEOUT_SECONDS = float(os.environ.get('GRPC_TIMEOUT_SECONDS') or 30)
+
+IMAGE_CONTENT_TYPES = ('application/x-image', 'image/png', 'image/jpeg')
+
+# one channel per TF Serving port and the (input, output) names of each model's serving
+# signature, looked up on first use and kept for the life of the process
+_channels = {}
+_signatures = {}
+_lock = threading.Lock()
+
+def load_image(image_bytes, img_size=IMG_SIZE):
+    # the same decode as training and the flask api: RGB, resized with nearest neighbour
+    img = Image.open(io.BytesIO(image_bytes))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    if img.size != (img_size, img_size):
+        img = img.resize((img_size, img_size), Image.NEAREST)
+    return np.asarray(img, dtype=np.uint8)
+
+def read_images(data, content_type):
+    # the (n, height, width, 3) images of a compact request
+    if content_type == 'application/x-npy':
+        images = np.load(io.BytesIO(data.read()), allow_pickle=False)
+    elif content_type in IMAGE_CONTENT_TYPES:
+        images = load_image(data.read())[np.newaxis]
+    elif content_type == 'application/x-npz':
+        with np.load(io.BytesIO(data.read()), allow_pickle=False) as files:
+            images = np.stack([load_image(files[f'arr_{i}'].tobytes()) for i in range(len(files.files))])
+    else:
+        raise ValueError(json.dumps({'error': f'unsupported content type {content_type}'}))
+    if images.ndim != 4 or images.shape[-1] != 3:
+        raise ValueError(json.dumps({'error': f'expected (n, height, width, 3) images, got {images.shape}'}))
+    return images
+
+def to_tensor_proto(array):
+    # the array's bytes as they are, rather than one float_val per value
+    shape = tensor_shape_pb2.TensorShapeProto(dim=[tensor_shape_pb2.TensorShapeProto.Dim(size=n) for n in array.shape])
+    return tensor_pb2.TensorProto(dtype=types_pb2.DT_FLOAT, tensor_shape=shape,
+                                  tensor_content=np.ascontiguousarray(array, dtype=np.float32).tobytes())
+
+def from_tensor_proto(tensor):
+    shape = [dim.size for dim in tensor.tensor_shape.dim]
+    if tensor.tensor_content:
+        return np.frombuffer(tensor.tensor_content, dtype=np.float32).reshape(shape)
+    return np.array(tensor.float_val, dtype=np.float32).reshape(shape)
+
+def prediction_service(grpc_port):
+    with _lock:
+        if grpc_port not in _channels:
+            _channels[grpc_port] = grpc.insecure_channel(f'localhost:{grpc_port}')
+        return prediction_service_pb2_grpc.PredictionServiceStub(_channels[grpc_port])
+
+def signature(stub, model_name):
+    # input and output names of the model's serving_default signature, which keras names
+    # after its layers
+    if model_name not in _signatures:
+        request = get_model_metadata_pb2.GetModelMetadataRequest()
+        request.model_spec.name = model_name
+        request.metadata_field.append('signature_def')
+        response = stub.GetModelMetadata(request, GRPC_TIMEOUT_SECONDS)
+        signatures = get_model_metadata_pb2.SignatureDefMap()
+        response.metadata['signature_def'].Unpack(signatures)
+        serving_default = signatures.signature_def['serving_default']
+        _signatures[model_name] = (next(iter(serving_default.inputs)), next(iter(serving_default.outputs)))
+    return _signatures[model_name]
+
+def predict_grpc(images, context):
+    # the model's predictions for a uint8 or float batch, scaled to [0, 1] like training
+    if images.dtype == np.uint8:
+        images = np.divide(images, np.float32(255), dtype=np.float32)
+    stub = prediction_service(context.grpc_port)
+    input_name, output_name = signature(stub, context.model_name)
+    request = predict_pb2.PredictRequest()
+    request.model_spec.name = context.model_name
+    request.model_spec.signature_name = 'serving_default'
+    request.inputs[input_name].CopyFrom(to_tensor_proto(images))
+    response = stub.Predict(request, GRPC_TIMEOUT_SECONDS)
+    return from_tensor_proto(response.outputs[output_name])
+
+def handler(data, context):
+    # returns the response body and its content type
+    content_type = context.request_content_type
+    if content_type == 'application/json':
+        response = requests.post(context.rest_uri, data=data.read())
+        if response.status_code != 200:
+            raise ValueError(response.content.decode('utf-8'))
+        return response.content, 'application/json'
+    predictions = predict_grpc(read_images(data, content_type), context)
+    return json.dumps({'predictions': predictions.tolist()}), 'application/json'
@@ -0,0 +1,167 @@
+import argparse
+import io
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import grpc
+import numpy as np
+import tensorflow as tf
+from tensorflow_serving.apis import get_model_metadata_pb2, predict_pb2, prediction_service_pb2_grpc
+
+# local stand-in for the SageMaker endpoint, to try request.py and code/inference.py offline.
+# it serves the model with Keras instead of TF Serving, but a request goes through the same
+# steps as in the container: code/inference.py's handler gets the payload and calls the
+# model through TF Serving's APIs, gRPC for the compact formats and REST for json, which
+# are stood in for here on --grpc_port and on the http port.
+#
+#   python local_endpoint.py -m model/cv_chart_model.h5
+#   python request.py -i awesome_chart.png --endpoint_url http://localhost:8080
+#
+# it answers SageMaker runtime's invoke_endpoint path, so request.py uses boto3 against it
+# unchanged, and the container's own /invocations and /ping. over loopback, sending a
+# request costs next to nothing, --bandwidth_mbps adds the time its body would take to
+# upload over a link of that speed, to compare payload formats as a remote client sees them.
+
+CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'code')
+sys.path.insert(0, CODE_DIR)
+from inference import from_tensor_proto, handler, to_tensor_proto
+
+INVOCATIONS_PATH = re.compile(r'^(/endpoints/[^/]+)?/invocations$')
+REST_PREDICT_PATH = re.compile(r'^/v1/models/[^/:]+:predict$')
+
+# what the TF Serving container passes to the handler
+Context = namedtuple('Context', ['model_name', 'model_version', 'method', 'rest_uri', 'grpc_port',
+                                 'custom_attributes', 'request_content_type', 'accept_header', 'content_length'])
+
+ap = argparse.ArgumentParser()
+ap.add_argument("-m", "--model", default=os.path.join('model', 'cv_chart_model.h5'),
+                help="path of the keras model to serve")
+ap.add_argument("-p", "--port", type=int, default=8080)
+ap.add_argument("--grpc_port", type=int, default=0,
+                help="port of the stand-in for TF Serving's gRPC API, 0 for any free port")
+ap.add_argument("--bandwidth_mbps", type=float, default=0,
+                help="simulated upload bandwidth of the client, 0 for none")
+
+class Model(object):
+    # the keras model behind a lock, TF Serving runs one request at a time per model here too
+
+    def __init__(self, path):
+        self.model = tf.keras.models.load_model(path, compile=False)
+        self._lock = threading.Lock()
+        if tf.executing_eagerly():
+            self._forward = tf.function(lambda batch: self.model(batch, training=False))
+        else:
+            self._forward = self.model.predict_on_batch
+            self._graph = tf.compat.v1.get_default_graph()
+
+    def predict(self, instances):
+        with self._lock:
+            if tf.executing_eagerly():
+                return np.asarray(self._forward(instances))
+            with self._graph.as_default():
+                return self._forward(instances)
+
+class PredictionService(prediction_service_pb2_grpc.PredictionServiceServicer):
+    # the parts of TF Serving's gRPC API the handler uses, with the signature names
+    # TF Serving takes from the keras model
+
+    def __init__(self, model):
+        self.model = model
+        self.input_name = model.model.input_names[0]
+        self.output_name = model.model.output_names[0]
+
+    def Predict(self, request, context):
+        predictions = self.model.predict(from_tensor_proto(request.inputs[self.input_name]))
+        response = predict_pb2.PredictResponse()
+        response.model_spec.CopyFrom(request.model_spec)
+        response.outputs[self.output_name].CopyFrom(to_tensor_proto(predictions))
+        return response
+
+    def GetModelMetadata(self, request, context):
+        signatures = get_model_metadata_pb2.SignatureDefMap()
+        serving_default = signatures.signature_def['serving_default']
+        serving_default.inputs[self.input_name].dtype = tf.float32.as_datatype_enum
+        serving_default.outputs[self.output_name].dtype = tf.float32.as_datatype_enum
+        response = get_model_metadata_pb2.GetModelMetadataResponse()
+        response.model_spec.CopyFrom(request.model_spec)
+        response.metadata['signature_def'].Pack(signatures)
+        return response
+
+def serve_grpc(model, port=0):
+    # starts the gRPC stand-in and returns the port it listens on
+    server = grpc.server(ThreadPoolExecutor(max_workers=4),
+                         options=[('grpc.max_receive_message_length', -1), ('grpc.max_send_message_length', -1)])
+    prediction_service_pb2_grpc.add_PredictionServiceServicer_to_server(PredictionService(model), server)
+    port = server.add_insecure_port(f'localhost:{port}')
+    server.start()
+    return server, port
+
+def invoke(body, content_type, accept, rest_uri, grpc_port):
+    # returns (status, body, content type) of one invocation
+    context = Context('model', None, 'POST', rest_uri, grpc_port, None, content_type, accept, len(body))
+    try:
+        response, content_type = handler(io.BytesIO(body), context)
+    except ValueError as e:
+        return 400, str(e).encode('utf-8'), 'application/json'
+    return 200, response.encode('utf-8') if isinstance(response, str) else response, content_type
+
+def rest_predict(model, body):
+    # TF Serving's REST predict API, which the handler passes json requests to
+    try:
+        instances = np.asarray(json.loads(body)['instances'], dtype=np.float32)
+    except (ValueError, KeyError, TypeError) as e:
+        return 400, json.dumps({'error': str(e)}).encode('utf-8'), 'application/json'
+    return 200, json.dumps({'predictions': model.predict(instances).tolist()}).encode('utf-8'), 'application/json'
+
+def make_handler(model, port, grpc_port, bandwidth_mbps=0):
+    rest_uri = f'http://localhost:{port}/v1/models/model:predict'
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            if self.path == '/ping':
+                self.respond(200, b'', 'text/plain')
+            else:
+                self.respond(404, b'not found', 'text/plain')
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            if REST_PREDICT_PATH.match(self.path):
+                self.respond(*rest_predict(model, body))
+                return
+            if not INVOCATIONS_PATH.match(self.path):
+                self.respond(404, b'not found', 'text/plain')
+                return
+            if bandwidth_mbps:
+                time.sleep(8 * len(body) / (bandwidth_mbps * 1e6))
+            start = time.perf_counter()
+            status, response, content_type = invoke(body, self.headers.get('Content-Type'),
+                                                    self.headers.get('Accept', 'application/json'), rest_uri, grpc_port)
+            self.respond(status, response, content_type)
+            self.log_message('%s %d bytes -> %d in %.1fms', self.headers.get('Content-Type'), len(body), status,
+                             1000 * (time.perf_counter() - start))
+
+        def respond(self, status, body, content_type):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+if __name__ == '__main__':
+    args = vars(ap.parse_args())
+    model = Model(args['model'])
+    grpc_server, grpc_port = serve_grpc(model, args['grpc_port'])
+    server = ThreadingHTTPServer(('', args['port']), make_handler(model, args['port'], grpc_port, args['bandwidth_mbps']))
+    print(f"serving {args['model']} on port {args['port']}, gRPC on port {grpc_port}")
+    server.serve_forever()
@@ -0,0 +1,80 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+
+# image decoding is shared with the flask api, so training and serving see the same pixels
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '00_jupyter_flask', 'api'))
+from preprocessing import load_image
+
+# decodes and resizes a directory of training images once into uint8 .npy shards, so
+# train.py --data_format shards does not re-read and re-decode every png every epoch.
+#
+#   python make_shards.py -i ../00_jupyter_flask/data/train -o shards/train --img_size 250
+#   python make_shards.py -i ../00_jupyter_flask/data/test -o shards/test --img_size 250
+#
+# the input directory has one sub directory per class like flow_from_directory expects,
+# and labels follow the same rule: classes in sorted order, so meme = 0 and chart = 1. the
+# output directory gets images_00000.npy (n, img_size, img_size, 3) and labels_00000.npy
+# per shard and a meta.json, and can be uploaded to S3 as a training channel.
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+ap = argparse.ArgumentParser()
+ap.add_argument("-i", "--input_dir", required=True,
+                help="directory with one sub directory of images per class")
+ap.add_argument("-o", "--output_dir", required=True,
+                help="directory to write the shards to")
+ap.add_argument("--img_size", type=int, default=250,
+                help="resolution to resize to, has to match train.py's img_size")
+ap.add_argument("--shard_size", type=int, default=1024,
+                help="images per shard")
+ap.add_argument("-w", "--workers", type=int, default=multiprocessing.cpu_count(),
+                help="decode worker processes")
+
+def list_images(input_dir):
+    classes = sorted(d for d in os.listdir(input_dir) if os.path.isdir(os.path.join(input_dir, d)))
+    paths, labels = [], []
+    for label, cls in enumerate(classes):
+        for name in sorted(os.listdir(os.path.join(input_dir, cls))):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(input_dir, cls, name))
+                labels.append(label)
+    return classes, paths, labels
+
+def decode(args):
+    # the same decode as keras' load_img in flow_from_directory: RGB, nearest neighbour,
+    # from the full size image rather than a reduced jpeg draft
+    path, img_size = args
+    return load_image(path, img_size, draft=False)
+
+if __name__ == '__main__':
+    args = vars(ap.parse_args())
+    classes, paths, labels = list_images(args['input_dir'])
+    os.makedirs(args['output_dir'], exist_ok=True)
+
+    shard_size = args['shard_size']
+    shards = []
+    with multiprocessing.Pool(args['workers']) as pool:
+        for shard, start in enumerate(range(0, len(paths), shard_size)):
+            shard_paths = paths[start:start + shard_size]
+            images_path = os.path.join(args['output_dir'], f'images_{shard:05d}.npy')
+            labels_path = os.path.join(args['output_dir'], f'labels_{shard:05d}.npy')
+            # written through a memmap, so a shard never has to fit in memory twice
+            images = np.lib.format.open_memmap(images_path, mode='w+', dtype=np.uint8,
+                                               shape=(len(shard_paths), args['img_size'], args['img_size'], 3))
+            for i, img in enumerate(pool.imap(decode, [(p, args['img_size']) for p in shard_paths], chunksize=16)):
+                images[i] = img
+            images.flush()
+            del images
+            np.save(labels_path, np.array(labels[start:start + shard_size], dtype=np.float32))
+            shards.append({'images': os.path.basename(images_path), 'labels': os.path.basename(labels_path),
+                           'n': len(shard_paths)})
+            print(f"shard {shard}: {len(shard_paths)} images -> {images_path}")
+
+    with open(os.path.join(args['output_dir'], 'meta.json'), 'w') as f:
+        json.dump({'classes': classes, 'img_size': args['img_size'], 'n': len(paths), 'shards': shards}, f, indent=2)
+    print(f"{len(paths)} images in {len(shards)} shards written to {args['output_dir']}")
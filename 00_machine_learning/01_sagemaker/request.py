@@ -1,43 +1,181 @@
 import argparse
 import boto3
-from sagemaker.predictor import json_serializer, json_deserializer
-from tensorflow.keras.preprocessing import image
+from sagemaker.predictor import json_serializer, npy_serializer
 import numpy as np
+import csv
+import io
 import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-# get sagemaker client using AWS SDK
-sage = boto3.client('sagemaker-runtime')
+# image preprocessing is shared with the flask api
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '00_jupyter_flask', 'api'))
+from preprocessing import IMG_SIZE, load_image, normalize
 
 # defining the api-endpoint
 MODEL_ENDPOINT = "test-tf-chart-cv-2019-05-02-02-35-19-315"
 
+# request formats, code/inference.py decodes the compact ones on the endpoint and sends
+# them to TF Serving over gRPC as a float32 tensor, so no side writes the pixels as text:
+#   json   the normalized float array as {"instances": [...]}, megabytes of text per image
+#   npy    the decoded and resized images as a uint8 array in .npy format, 3 bytes per pixel
+#   image  the image files as they are, the endpoint decodes and resizes them. several
+#          files go in an .npz archive
+CONTENT_TYPES = {'json': 'application/json', 'npy': 'application/x-npy', 'image': 'application/x-image'}
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# sagemaker rejects request bodies over 6MB
+MAX_PAYLOAD_MB = 5
+# bytes a request body can take per image on top of the image itself, for the npz entry
+# headers and json separators
+PER_IMAGE_OVERHEAD = 512
+# longest a scaled pixel value gets in json, with its separator
+JSON_BYTES_PER_VALUE = 22
+
 # taking input image via command line
 ap = argparse.ArgumentParser()
-ap.add_argument("-i", "--image", required=True,
-                help="path of the image")
-args = vars(ap.parse_args())
+source = ap.add_mutually_exclusive_group(required=True)
+source.add_argument("-i", "--image",
+                    help="path of the image")
+source.add_argument("-d", "--image_dir",
+                    help="classify every image in this directory, searched recursively, several per request")
+ap.add_argument("-f", "--format", default='npy', choices=list(CONTENT_TYPES),
+                help="request format")
+ap.add_argument("--endpoint", default=MODEL_ENDPOINT,
+                help="name of the sagemaker endpoint")
+ap.add_argument("--endpoint_url", default=None,
+                help="send to this url instead of sagemaker, e.g. http://localhost:8080 for local_endpoint.py")
+ap.add_argument("--max_payload_mb", type=float, default=MAX_PAYLOAD_MB,
+                help="largest request body in bulk mode")
+ap.add_argument("--max_batch", type=int, default=32,
+                help="most images per request in bulk mode")
+ap.add_argument("-c", "--concurrency", type=int, default=4,
+                help="requests in flight at once in bulk mode")
+ap.add_argument("-o", "--output", default='predictions.csv',
+                help="csv file for the predictions of bulk mode")
+
+def sagemaker_client(endpoint_url=None):
+    # get sagemaker client using AWS SDK. a local stand-in does not check the signature,
+    # so it works without AWS credentials
+    if endpoint_url is None:
+        return boto3.client('sagemaker-runtime')
+    return boto3.client('sagemaker-runtime', endpoint_url=endpoint_url, region_name='us-east-1',
+                        aws_access_key_id='local', aws_secret_access_key='local')
+
+def make_payload(image_paths, fmt):
+    # returns the request body for one or several images and its content type
+    if isinstance(image_paths, str):
+        image_paths = [image_paths]
+    if fmt == 'json':
+        images = np.stack([load_image(path) for path in image_paths])
+        return json_serializer({'instances': normalize(images)}), CONTENT_TYPES[fmt]
+    if fmt == 'npy':
+        return npy_serializer(np.stack([load_image(path) for path in image_paths])), CONTENT_TYPES[fmt]
+    files = []
+    for path in image_paths:
+        with open(path, 'rb') as f:
+            files.append(f.read())
+    if len(files) == 1:
+        return files[0], CONTENT_TYPES[fmt]
+    buffer = io.BytesIO()
+    np.savez(buffer, *[np.frombuffer(data, dtype=np.uint8) for data in files])
+    return buffer.getvalue(), 'application/x-npz'
+
+def payload_bytes(image_path, fmt):
+    # upper bound of what an image adds to a request body, without decoding it
+    if fmt == 'image':
+        size = os.path.getsize(image_path)
+    elif fmt == 'npy':
+        size = IMG_SIZE * IMG_SIZE * 3
+    else:
+        size = IMG_SIZE * IMG_SIZE * 3 * JSON_BYTES_PER_VALUE
+    return size + PER_IMAGE_OVERHEAD
+
+def pack(image_paths, fmt, max_payload_bytes, max_batch):
+    # groups the images into requests of up to max_batch images and max_payload_bytes,
+    # in order. an image bigger than the limit on its own goes in a request by itself
+    batches, batch, batch_bytes = [], [], 0
+    for path in image_paths:
+        size = payload_bytes(path, fmt)
+        if batch and (batch_bytes + size > max_payload_bytes or len(batch) == max_batch):
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append(path)
+        batch_bytes += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+def invoke(sage, endpoint, payload, content_type):
+    # sending post request and returning the predictions
+    response = sage.invoke_endpoint(EndpointName=endpoint,
+                            ContentType=content_type,
+                            Accept='application/json',
+                            Body=payload)
+    return json.loads(response.get('Body').read())['predictions']
 
-image_path = args['image']
+def list_images(image_dir):
+    return sorted(os.path.join(root, name) for root, _, names in os.walk(image_dir)
+                  for name in names if name.lower().endswith(IMAGE_EXTENSIONS))
 
-# define function to read and transform image 
-def transform_image(image_path):
-    img = image.img_to_array(image.load_img(image_path, target_size=(250, 250))) / 255
-    img = np.expand_dims(img, axis=0)
-    return img
+def classify_dir(sage, endpoint, image_dir, fmt, max_payload_bytes, max_batch, concurrency):
+    # classifies every image under image_dir with several images per request and up to
+    # concurrency requests in flight. payloads are built in the worker threads, so only
+    # the batches being sent are in memory. returns the batches, a row per classified image
+    # and the batches that failed with their error
+    batches = pack(list_images(image_dir), fmt, max_payload_bytes, max_batch)
 
-data = {'instances': transform_image(image_path)}
-payload = json_serializer(data)
+    def send(batch):
+        payload, content_type = make_payload(batch, fmt)
+        predictions = invoke(sage, endpoint, payload, content_type)
+        if len(predictions) != len(batch):
+            raise ValueError(f"{len(predictions)} predictions for {len(batch)} images")
+        return predictions
 
-# sending post request and saving response as response object
-response = sage.invoke_endpoint(EndpointName=MODEL_ENDPOINT,
-                        ContentType='application/json',
-                        Body=payload)
+    rows, failed = [], []
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [(batch, pool.submit(send, batch)) for batch in batches]
+        for batch, future in futures:
+            try:
+                predictions = future.result()
+            except Exception as e:
+                failed.append((batch, e))
+                continue
+            # predictions come back in the order of the images in the request
+            for path, prediction in zip(batch, predictions):
+                prob = prediction[0]
+                rows.append({'file': os.path.relpath(path, image_dir), 'probability': prob,
+                             'class': "Chart" if prob > .5 else "Meme"})
+    return batches, rows, failed
 
-r = response.get('Body').read()
-r = json.loads(r)
+if __name__ == '__main__':
+    args = vars(ap.parse_args())
+    if args['image_dir'] and args['format'] == 'json':
+        # at about 4MB per image, json fits one image per request under the payload limit
+        ap.error("--image_dir packs several images per request, which json cannot, use npy or image")
+    sage = sagemaker_client(args['endpoint_url'])
 
-prob = r['predictions'][0][0]
-cat = "Chart" if prob > .5 else "Meme"
+    if args['image']:
+        payload, content_type = make_payload(args['image'], args['format'])
+        prob = invoke(sage, args['endpoint'], payload, content_type)[0][0]
+        cat = "Chart" if prob > .5 else "Meme"
 
-# extracting the response
-print({"probability": prob, "class": cat})
\ No newline at end of file
+        # extracting the response
+        print({"probability": prob, "class": cat})
+    else:
+        start = time.time()
+        batches, rows, failed = classify_dir(sage, args['endpoint'], args['image_dir'], args['format'],
+                                             int(args['max_payload_mb'] * 2**20), args['max_batch'], args['concurrency'])
+        seconds = time.time() - start
+        with open(args['output'], 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['file', 'probability', 'class'])
+            writer.writeheader()
+            writer.writerows(rows)
+        for batch, e in failed:
+            print(f"request with {len(batch)} images from {batch[0]} failed: {e}")
+        print(f"{len(rows)} images in {len(batches)} requests classified in {seconds:.1f}s "
+              f"({len(rows) / seconds:.1f} images/s), predictions written to {args['output']}")
+        if failed:
+            sys.exit(1)
@@ -1,6 +1,11 @@
 import sagemaker
 from sagemaker.tensorflow import TensorFlow
+from sagemaker.tensorflow.serving import Model
+import boto3
 import json
+import os
+import tarfile
+import tempfile
 
 # define sagemaker execution role
 # this is name of sagemaker role that was created by CFT
@@ -17,26 +22,57 @@ inputs = {'train': train_data_s3_uri, 'test': test_data_s3_uri}
 
 # other inputs
 model_dir = '/opt/ml/model'
-train_instance_type = 'ml.p3.2xlarge'
 
 # load hyperparameters from hyperparameter config file
 with open("hyperparameters.json") as f:
     hyperparameters = json.load(f)
 
+# data parallel training: with distributed set to 1 in hyperparameters.json, SageMaker
+# starts train.py once per process with mpi and horovod averages the gradients. the
+# processes split the cores of a CPU instance, on ml.p3.2xlarge they would all share its
+# one GPU. bench_data_parallel.py measures how many processes per instance train fastest
+processes_per_host = 4
+if hyperparameters.get('distributed'):
+    train_instance_type = 'ml.c5.9xlarge'
+    distributions = {'mpi': {'enabled': True, 'processes_per_host': processes_per_host}}
+else:
+    train_instance_type = 'ml.p3.2xlarge'
+    distributions = None
+
 # create sagemaker TF Estimator for hosted training
 estimator = TensorFlow(entry_point='train.py',
                        model_dir=model_dir,
                        train_instance_type=train_instance_type,
                        train_instance_count=1,
                        hyperparameters=hyperparameters,
+                       distributions=distributions,
                        role=role,
                        base_job_name='test-tf-chart-cv',
                        framework_version='1.12.0',
                        py_version='py3',
                        script_mode=True)
 
+def with_inference_code(model_data, code_dir='code'):
+    # the tensorflow serving container runs code/inference.py from the model archive, which
+    # takes the compact request formats of request.py. uploads a copy of the trained model's
+    # archive with the code directory added next to it and returns its S3 uri
+    bucket, key = model_data[len('s3://'):].split('/', 1)
+    s3 = boto3.client('s3')
+    with tempfile.TemporaryDirectory() as tmp:
+        archive = os.path.join(tmp, 'model.tar.gz')
+        repacked = os.path.join(tmp, 'model_with_code.tar.gz')
+        s3.download_file(bucket, key, archive)
+        with tarfile.open(archive) as src, tarfile.open(repacked, 'w:gz') as dst:
+            for member in src.getmembers():
+                dst.addfile(member, src.extractfile(member) if member.isfile() else None)
+            dst.add(code_dir, arcname='code')
+        key = key.rsplit('/', 1)[0] + '/model_with_code.tar.gz'
+        s3.upload_file(repacked, bucket, key)
+    return f's3://{bucket}/{key}'
+
 # call to start hosted training
 estimator.fit(inputs)
 
-# deploy our estimator
-estimator.deploy(initial_instance_count=1, instance_type='ml.m5.large')
\ No newline at end of file
+# deploy our model with the inference code
+model = Model(model_data=with_inference_code(estimator.model_data), role=role, framework_version='1.12.0')
+model.deploy(initial_instance_count=1, instance_type='ml.m5.large')
\ No newline at end of file
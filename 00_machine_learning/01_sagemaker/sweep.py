@@ -0,0 +1,206 @@
+import argparse
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+# local hyperparameter sweep for train.py. expands the search space in sweep_space.json
+# into trials, trains them side by side in separate processes with a capped number of TF
+# threads each, stops trials that fall behind and collects validation accuracy, training
+# throughput and inference latency of every trial into one leaderboard.
+#
+#   python sweep.py --train ../00_jupyter_flask/data/train --test ../00_jupyter_flask/data/test
+#   python sweep.py --max_trials 8 --parallel 4 --threads_per_trial 2 --epochs 3
+#
+# every trial runs train.py exactly the way SageMaker script mode does, with the values of
+# hyperparameters.json and the trial's own as command line arguments. arguments sweep.py
+# does not know, like --epochs above, are passed on to every trial.
+
+TRAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'train.py')
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '00_jupyter_flask', 'data')
+
+ap = argparse.ArgumentParser()
+ap.add_argument("--space", default='sweep_space.json',
+                help="json file mapping hyperparameters to the values to try")
+ap.add_argument("--base", default='hyperparameters.json',
+                help="hyperparameters every trial starts from")
+ap.add_argument("--train", default=os.path.join(DATA_DIR, 'train'))
+ap.add_argument("--test", default=os.path.join(DATA_DIR, 'test'))
+ap.add_argument("-o", "--output_dir", default='sweep',
+                help="one sub directory per trial and the leaderboard go here")
+ap.add_argument("--threads_per_trial", type=int, default=1,
+                help="TF intra-op threads of each trial")
+ap.add_argument("-p", "--parallel", type=int, default=None,
+                help="trials trained at once, defaults to CPUs / threads_per_trial")
+ap.add_argument("-n", "--max_trials", type=int, default=None,
+                help="sample this many trials from the search space instead of trying all of them")
+ap.add_argument("--seed", type=int, default=0)
+ap.add_argument("--grace_epochs", type=int, default=1,
+                help="epochs every trial trains before it can be stopped")
+ap.add_argument("--min_trials", type=int, default=3,
+                help="other trials that must have reached an epoch before trials are compared at it")
+ap.add_argument("--poll_seconds", type=float, default=2)
+
+def consistent(params):
+    # train.py needs one filter count and one kernel size per conv layer
+    n = params.get('n_conv_layers')
+    return all(n is None or key not in params or len(str(params[key]).split(',')) == n
+               for key in ('n_filters', 'kernel_sizes'))
+
+def expand(space, max_trials, seed):
+    keys = sorted(space)
+    trials = [dict(zip(keys, values)) for values in itertools.product(*(space[k] for k in keys))]
+    trials = [t for t in trials if consistent(t)]
+    if max_trials is not None and max_trials < len(trials):
+        trials = random.Random(seed).sample(trials, max_trials)
+    return trials
+
+def to_args(params):
+    return [arg for key, value in params.items() for arg in (f'--{key}', str(value))]
+
+class Trial(object):
+
+    def __init__(self, trial_id, params, output_dir):
+        self.id = trial_id
+        self.params = params
+        self.dir = os.path.join(output_dir, trial_id)
+        self.progress_file = os.path.join(self.dir, 'progress.jsonl')
+        self.epochs = []
+        self.status = 'pending'
+        self.process = None
+        self._log = None
+
+    def start(self, base, passthrough, args):
+        os.makedirs(self.dir, exist_ok=True)
+        if os.path.exists(self.progress_file):
+            os.remove(self.progress_file)
+        # trials compare the main model, the cascade can be trained for the winner
+        command = [sys.executable, TRAIN_SCRIPT] + to_args(base) + ['--train_cascade', '0'] + passthrough + to_args(self.params) + [
+            '--model_dir', self.dir, '--train', args['train'], '--test', args['test'],
+            '--intra_op_threads', str(args['threads_per_trial']), '--inter_op_threads', '1',
+            '--progress_file', self.progress_file]
+        # numpy and the image decoders get the same cap as TF
+        env = dict(os.environ, OMP_NUM_THREADS=str(args['threads_per_trial']))
+        self._log = open(os.path.join(self.dir, 'train.log'), 'w')
+        self.process = subprocess.Popen(command, stdout=self._log, stderr=subprocess.STDOUT, env=env)
+        self.status = 'running'
+
+    def poll(self):
+        # picks up newly finished epochs, returns True once the process has exited
+        if os.path.exists(self.progress_file):
+            with open(self.progress_file) as f:
+                self.epochs = [json.loads(line) for line in f if line.strip()]
+        if self.process.poll() is None:
+            return False
+        self._log.close()
+        if self.status == 'running':
+            self.status = 'done' if self.process.returncode == 0 else 'failed'
+        return True
+
+    def stop(self):
+        self.status = 'stopped'
+        self.process.terminate()
+
+    def val_accuracy_at(self, epoch):
+        if len(self.epochs) < epoch:
+            return None
+        return self.epochs[epoch - 1]['val_accuracy']
+
+def should_stop(trial, trials, grace_epochs, min_trials):
+    # median stopping rule: a trial is stopped once its validation accuracy after an epoch
+    # is below the median of what the other trials had after the same epoch
+    epoch = len(trial.epochs)
+    if epoch < max(1, grace_epochs):
+        return False
+    accuracy = trial.val_accuracy_at(epoch)
+    if accuracy is None:
+        return False
+    others = [t.val_accuracy_at(epoch) for t in trials if t is not trial]
+    others = [a for a in others if a is not None]
+    return len(others) >= min_trials and accuracy < np.median(others)
+
+def summarize(trial):
+    row = {'trial': trial.id, 'status': trial.status, 'epochs': len(trial.epochs),
+           'val_accuracy': trial.epochs[-1]['val_accuracy'] if trial.epochs else None,
+           'images_per_sec': None, 'latency_ms': None, 'params': None, 'mflops': None,
+           'hyperparameters': ' '.join(f'{k}={v}' for k, v in sorted(trial.params.items()))}
+    # throughput without the first epoch, which also builds the graph
+    steady = trial.epochs[1:] or trial.epochs
+    if steady:
+        row['images_per_sec'] = float(np.mean([e['images_per_sec'] for e in steady]))
+    report_path = os.path.join(trial.dir, 'model_report.json')
+    if trial.status == 'done' and os.path.exists(report_path):
+        with open(report_path) as f:
+            report = json.load(f)['model']
+        row.update(val_accuracy=report['val_accuracy'], latency_ms=report['cpu_latency_ms']['batch_1'],
+                   params=report['params'], mflops=report['flops'] / 1e6)
+    return row
+
+def write_leaderboard(rows, output_dir):
+    # finished trials first, best validation accuracy on top
+    order = {'done': 0, 'stopped': 1, 'failed': 2}
+    rows = sorted(rows, key=lambda r: (order.get(r['status'], 3), -(r['val_accuracy'] or 0)))
+    path = os.path.join(output_dir, 'leaderboard.csv')
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['rank'] + list(rows[0]))
+        writer.writeheader()
+        for rank, row in enumerate(rows, 1):
+            writer.writerow(dict(row, rank=rank))
+    return rows, path
+
+def fmt(value, spec):
+    return format(value, spec) if value is not None else '-'
+
+if __name__ == '__main__':
+    args, passthrough = ap.parse_known_args()
+    args = vars(args)
+    with open(args['space']) as f:
+        space = json.load(f)
+    with open(args['base']) as f:
+        base = {k: v for k, v in json.load(f).items() if k not in space}
+
+    parallel = args['parallel'] or max(1, multiprocessing.cpu_count() // args['threads_per_trial'])
+    trials = [Trial(f'trial_{i:03d}', params, args['output_dir'])
+              for i, params in enumerate(expand(space, args['max_trials'], args['seed']))]
+    print(f"{len(trials)} trials, {parallel} at a time with {args['threads_per_trial']} threads each")
+
+    pending = list(trials)
+    running = []
+    start = time.time()
+    try:
+        while pending or running:
+            while pending and len(running) < parallel:
+                trial = pending.pop(0)
+                trial.start(base, passthrough, args)
+                running.append(trial)
+            time.sleep(args['poll_seconds'])
+            for trial in list(running):
+                if trial.poll():
+                    running.remove(trial)
+                    print(f"{trial.id} {trial.status} after {len(trial.epochs)} epochs "
+                          f"({len(trials) - len(pending) - len(running)}/{len(trials)} finished)")
+                elif trial.status == 'running' and should_stop(trial, trials, args['grace_epochs'], args['min_trials']):
+                    print(f"{trial.id} stopped early, val accuracy {trial.epochs[-1]['val_accuracy']:.3f} "
+                          f"after epoch {len(trial.epochs)} is below the median")
+                    trial.stop()
+    finally:
+        # an interrupted sweep does not leave trials training in the background
+        for trial in running:
+            if trial.process.poll() is None:
+                trial.process.terminate()
+
+    rows, path = write_leaderboard([summarize(t) for t in trials], args['output_dir'])
+    print(f"sweep took {time.time() - start:.0f}s, leaderboard written to {path}")
+    print("| rank | trial | status | val accuracy | images/s | latency (ms) | params | hyperparameters |")
+    print("| --- | --- | --- | --- | --- | --- | --- | --- |")
+    for rank, r in enumerate(rows[:10], 1):
+        print(f"| {rank} | {r['trial']} | {r['status']} | {fmt(r['val_accuracy'], '.3f')} | "
+              f"{fmt(r['images_per_sec'], '.1f')} | {fmt(r['latency_ms'], '.2f')} | {fmt(r['params'], ',')} | "
+              f"{r['hyperparameters']} |")
@@ -3,11 +3,23 @@ import tensorflow as tf
 import numpy as np
 import os
 import glob
+import gzip
+import json
+import multiprocessing
+import resource
+import shutil
+import tempfile
+import threading
+import time
+from io import BytesIO
 
+import h5py
 from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import Conv2D, MaxPooling2D, ZeroPadding2D
-from tensorflow.keras.layers import Activation, Dropout, Flatten, Dense
+from tensorflow.keras.layers import AveragePooling2D, Conv2D, MaxPooling2D, SeparableConv2D, ZeroPadding2D
+from tensorflow.keras.layers import Activation, Dropout, Flatten, Dense, GlobalAveragePooling2D
 from tensorflow.keras.preprocessing.image import ImageDataGenerator
+from tensorflow.keras.callbacks import Callback
+from tensorflow.keras.utils import Sequence
 
 def parse_args():
 
@@ -17,6 +29,26 @@ def parse_args():
     parser.add_argument('--train', type=str, default=os.environ.get('SM_CHANNEL_TRAIN'))
     parser.add_argument('--test', type=str, default=os.environ.get('SM_CHANNEL_TEST'))
 
+    # directory reads the image directories with flow_from_directory, shards reads the
+    # decoded uint8 shards written by make_shards.py from the same channels
+    parser.add_argument('--data_format', type=str, default='directory', choices=['directory', 'shards'])
+    # batches prepared ahead of the model by this many worker threads
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--max_queue_size', type=int, default=10)
+    # TF thread pool sizes, 0 leaves them to TF. sweep.py caps them so that trials
+    # running side by side do not fight over the same cores
+    parser.add_argument('--intra_op_threads', type=int, default=0)
+    parser.add_argument('--inter_op_threads', type=int, default=0)
+    # every epoch's metrics are appended to this file as a json line, for sweep.py to
+    # follow the trial and stop it early
+    parser.add_argument('--progress_file', type=str, default=None)
+    # data parallel training with horovod: one process per group of cores, each trains on
+    # its own part of the training data and the gradients are averaged across processes
+    # after every step. train.py is started once per process by mpirun or horovodrun, or by
+    # a SageMaker job with the mpi distribution (sage_train_and_deploy.py). the learning
+    # rate is scaled by the number of processes, since the global batch grows with it.
+    parser.add_argument('--distributed', type=int, default=0)
+
     # hyperparameters sent by the client are passed as command-line arguments to the script
     parser.add_argument('--epochs', type=int, default=5)
     parser.add_argument('--batch_size', type=int, default=32)
@@ -28,6 +60,34 @@ def parse_args():
     parser.add_argument('--n_filters', type=lambda s: [int(filter_size) for filter_size in s.split(",")], default=[32,32,64])
     parser.add_argument('--kernel_sizes', type=lambda s: [int(filter_size) for filter_size in s.split(",")], default=[3,3,3])
     parser.add_argument('--optimizer', type=str, default='rmsprop')
+    # latency options: a gap head averages the last feature map instead of flattening it,
+    # which removes most of the parameters of the first dense layer, separable convolutions
+    # split each convolution into a per channel and a 1x1 convolution. smaller inputs are
+    # set with img_size, the api decodes images at the model's input size.
+    parser.add_argument('--head', type=str, default='flatten', choices=['flatten', 'gap'])
+    parser.add_argument('--conv_type', type=str, default='standard', choices=['standard', 'separable'])
+    parser.add_argument('--n_latency_runs', type=int, default=50)
+
+    # a much smaller model can be trained alongside the full one for a serving cascade: it
+    # classifies every image and the full model only runs when its probability falls
+    # between cascade_low and cascade_high. it takes the same input as the full model and
+    # downsamples it by cascade_downsample first.
+    parser.add_argument('--train_cascade', type=int, default=0)
+    parser.add_argument('--cascade_downsample', type=int, default=4)
+    parser.add_argument('--cascade_n_conv_layers', type=int, default=2)
+    parser.add_argument('--cascade_n_filters', type=lambda s: [int(filter_size) for filter_size in s.split(",")], default=[8,16])
+    parser.add_argument('--cascade_kernel_sizes', type=lambda s: [int(filter_size) for filter_size in s.split(",")], default=[3,3])
+    parser.add_argument('--cascade_low', type=float, default=0.2)
+    parser.add_argument('--cascade_high', type=float, default=0.8)
+
+    # post-training magnitude pruning: after training, the smallest weights of the conv and
+    # dense kernels are set to zero in steps over prune_epochs epochs of fine-tuning, until
+    # prune_sparsity of them are zero. zeros compress well, so the pruned model is saved
+    # gzipped as cv_chart_model_pruned.h5.gz and compared with the trained model in
+    # pruning_report.json.
+    parser.add_argument('--prune', type=int, default=0)
+    parser.add_argument('--prune_sparsity', type=float, default=0.8)
+    parser.add_argument('--prune_epochs', type=int, default=2)
 
     # number of training samples to define steps per epochs
     parser.add_argument('--n_train_samples', type=int, default=1000)
@@ -35,19 +95,23 @@ def parse_args():
 
     return parser.parse_known_args()
 
-def get_image_data_gens(train_dir, test_dir, batch_size, img_size):
+def get_image_data_gens(train_dir, test_dir, batch_size, img_size, rank=0, n_workers=1):
     # can define data augmentations here, we will scale images values between 0 and 1
     train_datagen = ImageDataGenerator(rescale=1/255)
     val_datagen = ImageDataGenerator(rescale=1/255)
 
     # this is a generator that will read pictures found in
     # subfolers of 'data/train', and indefinitely generate
-    # batches of augmented image data
+    # batches of augmented image data. with several processes, DirectoryShard gives
+    # each one its own batches of it
     train_generator = train_datagen.flow_from_directory(
             train_dir,  # this is the target directory
             batch_size=batch_size,
             target_size=(img_size, img_size),
-            class_mode='binary')
+            class_mode='binary',
+            shuffle=n_workers == 1)
+    if n_workers > 1:
+        train_generator = DirectoryShard(train_generator, rank=rank, n_workers=n_workers)
 
     # this is a similar generator, for validation data
     test_generator = val_datagen.flow_from_directory(
@@ -58,7 +122,82 @@ def get_image_data_gens(train_dir, test_dir, batch_size, img_size):
 
     return train_generator, test_generator
 
-def create_model(n_conv_layers, n_filters, kernel_sizes, img_size):
+class DirectoryShard(Sequence):
+    # every n_workers-th batch of a DirectoryIterator, starting at rank. flow_from_directory
+    # cannot read part of a directory, so every process lists all the images and shuffles
+    # them the same way from a common seed, and the processes take turns at the batches.
+    # the iterator's own reshuffle draws from numpy's global state, which differs between
+    # processes, so the order is set here instead.
+
+    def __init__(self, iterator, seed=0, rank=0, n_workers=1):
+        self.iterator = iterator
+        self.batch_size = iterator.batch_size
+        self.rank = rank
+        self.n_workers = n_workers
+        self._rng = np.random.RandomState(seed)
+        self.on_epoch_end()
+
+    def __len__(self):
+        return len(self.iterator) // self.n_workers
+
+    def __getitem__(self, idx):
+        return self.iterator[self.rank + idx * self.n_workers]
+
+    def on_epoch_end(self):
+        self.iterator.index_array = self._rng.permutation(self.iterator.n)
+
+class ShardSequence(Sequence):
+    # batches from the uint8 shards written by make_shards.py. the shards are memory
+    # mapped, so only the rows of the current batches are read, and the page cache keeps
+    # them in memory after the first epoch. rows are reshuffled across shards every epoch
+    # and scaled to [0, 1] like ImageDataGenerator(rescale=1/255) does. in data parallel
+    # training every process reads every n_workers-th image, starting at its rank.
+
+    def __init__(self, shard_dir, batch_size, shuffle=True, seed=None, rank=0, n_workers=1):
+        with open(os.path.join(shard_dir, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.img_size = self.meta['img_size']
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.images = [np.load(os.path.join(shard_dir, shard['images']), mmap_mode='r') for shard in self.meta['shards']]
+        self.labels = [np.load(os.path.join(shard_dir, shard['labels'])) for shard in self.meta['shards']]
+        # (shard, row) of every image
+        self.index = np.array([(shard, row) for shard, labels in enumerate(self.labels) for row in range(len(labels))])
+        self.index = self.index[rank::n_workers]
+        self.samples = len(self.index)
+        self._rng = np.random.RandomState(seed)
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.ceil(self.samples / self.batch_size))
+
+    def __getitem__(self, idx):
+        rows = self.order[idx * self.batch_size:(idx + 1) * self.batch_size]
+        images = np.empty((len(rows), self.img_size, self.img_size, 3), dtype=np.float32)
+        labels = np.empty(len(rows), dtype=np.float32)
+        # gathered shard by shard in row order, so reads from each memmap stay sequential
+        for i in np.lexsort((self.index[rows, 1], self.index[rows, 0])):
+            shard, row = self.index[rows[i]]
+            images[i] = self.images[shard][row]
+            labels[i] = self.labels[shard][row]
+        images *= 1 / 255
+        return images, labels
+
+    def on_epoch_end(self):
+        self.order = self._rng.permutation(self.samples) if self.shuffle else np.arange(self.samples)
+
+def get_shard_data_gens(train_dir, test_dir, batch_size, img_size, rank=0, n_workers=1):
+    # every process validates on the whole test set
+    train_sequence = ShardSequence(train_dir, batch_size, rank=rank, n_workers=n_workers)
+    test_sequence = ShardSequence(test_dir, batch_size)
+    for sequence in (train_sequence, test_sequence):
+        if sequence.img_size != img_size:
+            raise ValueError(f"shards are {sequence.img_size}px but img_size is {img_size}, rerun make_shards.py")
+    print(f"Found {train_sequence.samples} training and {test_sequence.samples} test images in shards"
+          + (f" for process {rank} of {n_workers}" if n_workers > 1 else ""))
+    return train_sequence, test_sequence
+
+def create_model(n_conv_layers, n_filters, kernel_sizes, img_size, downsample=1, head='flatten', conv_type='standard'):
     # need to make sure that n_layers, filter size and kernel sizes are equal
     try:
         assert n_conv_layers == len(n_filters), f"CNN has {n_conv_layers} layers but len(n_filters) = {len(n_filters)}"
@@ -73,14 +212,23 @@ def create_model(n_conv_layers, n_filters, kernel_sizes, img_size):
     # instantiate model
     model = Sequential()
 
+    # the cascade's small model averages the input down before its first convolution, so
+    # it can be served on the same preprocessed images as the full model
+    if downsample > 1:
+        model.add(AveragePooling2D(pool_size=(downsample, downsample), input_shape=(img_size, img_size, 3)))
+
     # add convolutional layers
+    conv_layer = SeparableConv2D if conv_type == 'separable' else Conv2D
     for i in range(n_conv_layers):
-        model.add(Conv2D(n_filters[i], (kernel_sizes[i], kernel_sizes[i]), input_shape=(img_size, img_size, 3)))
+        model.add(conv_layer(n_filters[i], (kernel_sizes[i], kernel_sizes[i]), input_shape=(img_size, img_size, 3)))
         model.add(Activation('relu'))
         model.add(MaxPooling2D(pool_size=(2, 2)))
 
     # add fully connected layers
-    model.add(Flatten())
+    if head == 'gap':
+        model.add(GlobalAveragePooling2D())
+    else:
+        model.add(Flatten())
     model.add(Dense(64))
     model.add(Activation('relu'))
     model.add(Dropout(0.5))
@@ -89,22 +237,419 @@ def create_model(n_conv_layers, n_filters, kernel_sizes, img_size):
 
     return model
 
-if __name__ == "__main__":
+def configure_threads(intra_op_threads, inter_op_threads):
+    # has to run before the first model is built
+    if not (intra_op_threads or inter_op_threads):
+        return
+    if hasattr(tf, 'config') and hasattr(tf.config, 'threading'):
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    else:
+        # TF 1.x takes them per session
+        config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                                inter_op_parallelism_threads=inter_op_threads)
+        tf.keras.backend.set_session(tf.Session(config=config))
 
-    args, _ = parse_args()
-    train_generator, test_generator = get_image_data_gens(args.train, args.test, args.batch_size, args.img_size)
-    model = create_model(args.n_conv_layers, args.n_filters, args.kernel_sizes, args.img_size)
+def init_distributed(args):
+    # returns horovod's keras module in data parallel training, None otherwise
+    if not args.distributed:
+        return None
+    import horovod.tensorflow.keras as hvd
+    hvd.init()
+    if not args.intra_op_threads:
+        # the processes on one machine share its cores
+        args.intra_op_threads = max(1, multiprocessing.cpu_count() // hvd.local_size())
+    return hvd
+
+def current_rss_mb():
+    # resident memory of this process right now, linux only, None elsewhere
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 2**20
+    except (OSError, ValueError, IndexError):
+        return None
+
+class TimedSequence(Sequence):
+    # wraps a keras Sequence (a DirectoryIterator, DirectoryShard or ShardSequence) and adds up the time
+    # spent reading and decoding batches, across all the prefetch worker threads
+
+    def __init__(self, sequence):
+        self.sequence = sequence
+        self.batch_size = sequence.batch_size
+        self.seconds = 0.
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def __getitem__(self, idx):
+        start = time.perf_counter()
+        batch = self.sequence[idx]
+        with self._lock:
+            self.seconds += time.perf_counter() - start
+        return batch
+
+    def on_epoch_end(self):
+        self.sequence.on_epoch_end()
+
+class ThroughputCallback(Callback):
+    # times every training step to tell input bound from compute bound training, reported
+    # per epoch with images/sec and peak memory. the first epoch includes building the graph.
+    #   input_wait: time between the end of one step and the start of the next, where
+    #     TF 1.x fetches the next batch. TF 2.x fetches it inside the step, so this is ~0
+    #     there and the step time includes any wait.
+    #   input: time the input pipeline spent producing batches. with prefetch workers
+    #     this overlaps compute, training is input bound when it gets close to the epoch.
+    #   compute: time from the start to the end of each step.
+    # in data parallel training every step trains one batch in each of the n_workers
+    # processes, images and images/sec count the images of all of them.
+
+    def __init__(self, batch_size, timed_input=None, progress_file=None, n_workers=1, verbose=True):
+        super(ThroughputCallback, self).__init__()
+        self.batch_size = batch_size
+        self.timed_input = timed_input
+        self.progress_file = progress_file
+        self.n_workers = n_workers
+        self.verbose = verbose
+        self.epochs = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch_start = time.perf_counter()
+        self._last_step_end = self._epoch_start
+        self._input_wait = 0.
+        self._compute = 0.
+        self._steps = 0
+        self._images = 0
+        self._peak_rss = current_rss_mb()
+        self._input_start = self.timed_input.seconds if self.timed_input is not None else None
+
+    def on_batch_begin(self, batch, logs=None):
+        self._step_start = time.perf_counter()
+        self._input_wait += self._step_start - self._last_step_end
+
+    def on_batch_end(self, batch, logs=None):
+        self._last_step_end = time.perf_counter()
+        self._compute += self._last_step_end - self._step_start
+        self._steps += 1
+        # TF 1.x logs the size of every batch, TF 2.x does not
+        self._images += (logs or {}).get('size', self.batch_size) * self.n_workers
+        rss = current_rss_mb()
+        if rss is not None and (self._peak_rss is None or rss > self._peak_rss):
+            self._peak_rss = rss
+
+    def on_epoch_end(self, epoch, logs=None):
+        # the training steps only, validation runs after the last step
+        train_time = self._last_step_end - self._epoch_start
+        logs = logs or {}
+        val_accuracy = logs.get('val_accuracy', logs.get('val_acc'))
+        self.epochs.append({
+            'epoch': epoch + 1,
+            'loss': float(logs['loss']) if 'loss' in logs else None,
+            'val_accuracy': float(val_accuracy) if val_accuracy is not None else None,
+            'steps': self._steps,
+            'workers': self.n_workers,
+            'images': self._images,
+            'images_per_sec': self._images / train_time if train_time > 0 else None,
+            'step_time_ms': 1000 * train_time / max(1, self._steps),
+            'input_wait_seconds': self._input_wait,
+            'input_seconds': self.timed_input.seconds - self._input_start if self.timed_input is not None else None,
+            'compute_seconds': self._compute,
+            'input_wait_fraction': self._input_wait / train_time if train_time > 0 else None,
+            'epoch_seconds': time.perf_counter() - self._epoch_start,
+            'peak_rss_mb': self._peak_rss,
+            # ru_maxrss is in kilobytes on linux, the high water mark of the whole process
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        })
+        e = self.epochs[-1]
+        if not self.verbose:
+            return
+        print(f"epoch {e['epoch']}: {e['images_per_sec']:.1f} images/s, {e['step_time_ms']:.0f}ms/step, "
+              f"{e['input_wait_seconds']:.1f}s waiting on input, {e['input_seconds'] or 0:.1f}s producing input, "
+              f"{e['compute_seconds']:.1f}s in steps, peak memory {e['peak_rss_mb'] or 0:.0f}MB")
+        if self.progress_file:
+            with open(self.progress_file, 'a') as f:
+                f.write(json.dumps(e) + '\n')
+
+def distributed_optimizer(name, hvd):
+    # the optimizer with its default learning rate scaled by the number of processes,
+    # wrapped to average the gradients of all processes before every update
+    optimizer = tf.keras.optimizers.get(name)
+    config = optimizer.get_config()
+    key = 'learning_rate' if 'learning_rate' in config else 'lr'
+    config[key] = config[key] * hvd.size()
+    return hvd.DistributedOptimizer(optimizer.__class__.from_config(config))
 
+def train_model(model, args, train_generator, test_generator, progress_file=None, hvd=None, epochs=None, callbacks=()):
+    # returns the keras history and the throughput of every epoch. trains for args.epochs
+    # unless epochs is given, callbacks run before the throughput callback
+    n_workers = hvd.size() if hvd is not None else 1
+    is_chief = hvd is None or hvd.rank() == 0
     model.compile(loss='binary_crossentropy',
-              optimizer=args.optimizer,
+              optimizer=distributed_optimizer(args.optimizer, hvd) if hvd is not None else args.optimizer,
               metrics=['accuracy'])
 
-    model.fit_generator(
-            train_generator,
-            steps_per_epoch=args.n_train_samples // args.batch_size,
-            epochs=args.epochs,
+    callbacks = list(callbacks)
+    if hvd is not None:
+        # start every process from the weights of the first one, and average the
+        # validation metrics before the throughput callback reports them
+        callbacks = [hvd.callbacks.BroadcastGlobalVariablesCallback(0), hvd.callbacks.MetricAverageCallback()] + callbacks
+    timed_generator = TimedSequence(train_generator)
+    throughput = ThroughputCallback(args.batch_size, timed_generator, progress_file, n_workers, verbose=is_chief)
+    # an epoch is still n_train_samples images, split across the processes
+    history = model.fit_generator(
+            timed_generator,
+            steps_per_epoch=args.n_train_samples // (args.batch_size * n_workers),
+            epochs=epochs or args.epochs,
             validation_data=test_generator,
-            validation_steps=args.n_test_samples // args.batch_size)
+            validation_steps=args.n_test_samples // args.batch_size,
+            workers=args.workers,
+            max_queue_size=args.max_queue_size,
+            callbacks=callbacks + [throughput],
+            verbose=1 if is_chief else 0)
+    return history, throughput.epochs
+
+def evaluate_cascade(small_model, model, test_generator, args):
+    # runs both models on the same test batches and reports how much traffic the small
+    # model answers on its own and what that does to accuracy
+    small_probs, full_probs, labels = [], [], []
+    for i in range(max(1, args.n_test_samples // test_generator.batch_size)):
+        images, batch_labels = test_generator[i]
+        small_probs.append(small_model.predict(images)[:, 0])
+        full_probs.append(model.predict(images)[:, 0])
+        labels.append(batch_labels)
+    small_probs, full_probs, labels = np.concatenate(small_probs), np.concatenate(full_probs), np.concatenate(labels)
+
+    escalated = (small_probs > args.cascade_low) & (small_probs < args.cascade_high)
+    cascade_probs = np.where(escalated, full_probs, small_probs)
+    print(f"cascade: {100 * escalated.mean():.1f}% of test images escalated to the full model, "
+          f"accuracy small {np.mean((small_probs > .5) == labels):.3f}, "
+          f"full {np.mean((full_probs > .5) == labels):.3f}, "
+          f"cascade {np.mean((cascade_probs > .5) == labels):.3f}")
+
+def prunable_layers(model):
+    # conv and dense layers, except the output layer with its handful of weights
+    layers = [layer for layer in model.layers if isinstance(layer, (Conv2D, SeparableConv2D, Dense))]
+    return layers[:-1]
+
+class MagnitudePruning(Callback):
+    # zeroes the smallest weights of every kernel of the prunable layers, biases are kept.
+    # the fraction of zeros rises on a cubic schedule, most of it in the first epochs, and
+    # reaches final_sparsity at the start of the last epoch, so training makes up for each
+    # step before the next. the masks are reapplied after every training step so the
+    # optimizer cannot grow pruned weights back.
+
+    def __init__(self, final_sparsity, epochs):
+        super(MagnitudePruning, self).__init__()
+        self.final_sparsity = final_sparsity
+        self.epochs = epochs
+        self.masks = {}
+
+    def on_epoch_begin(self, epoch, logs=None):
+        sparsity = self.final_sparsity * (1 - (1 - min(1., (epoch + 1) / self.epochs)) ** 3)
+        for layer in prunable_layers(self.model):
+            masks = []
+            for weights in layer.get_weights():
+                if weights.ndim < 2:
+                    masks.append(None)
+                    continue
+                # weights pruned in earlier epochs are zero, so they stay pruned
+                mask = np.ones(weights.size, dtype=weights.dtype)
+                mask[np.argsort(np.abs(weights), axis=None)[:int(sparsity * weights.size)]] = 0
+                masks.append(mask.reshape(weights.shape))
+            self.masks[layer.name] = masks
+        self.apply_masks()
+        print(f"pruning epoch {epoch + 1}: {100 * sparsity:.1f}% of the kernel weights set to zero")
+
+    def on_batch_end(self, batch, logs=None):
+        self.apply_masks()
+
+    def apply_masks(self):
+        for layer in prunable_layers(self.model):
+            layer.set_weights([w if m is None else w * m for w, m in zip(layer.get_weights(), self.masks[layer.name])])
+
+def kernel_sparsity(model):
+    # fraction of zeros in the kernels of the prunable layers
+    kernels = [w for layer in prunable_layers(model) for w in layer.get_weights() if w.ndim > 1]
+    return float(sum(np.sum(w == 0) for w in kernels) / sum(w.size for w in kernels))
+
+def save_compressed(model, path):
+    # gzipped .h5 without the optimizer state, which serving does not need. the flask api
+    # loads gzipped models as they are
+    with tempfile.TemporaryDirectory() as tmp:
+        h5_path = os.path.join(tmp, 'model.h5')
+        model.save(h5_path, include_optimizer=False)
+        with open(h5_path, 'rb') as f_in, gzip.open(path, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+    return path
+
+def load_seconds(path, n_runs=3):
+    # median time to read and load the model file the way the flask api does, from its bytes
+    times = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        with open(path, 'rb') as f:
+            model_bytes = f.read()
+        if path.endswith('.gz'):
+            model_bytes = gzip.decompress(model_bytes)
+        tf.keras.models.load_model(h5py.File(BytesIO(model_bytes), 'r'), compile=False)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+def test_accuracy(model, test_generator, args):
+    correct, total = 0, 0
+    for i in range(max(1, args.n_test_samples // test_generator.batch_size)):
+        images, labels = test_generator[i]
+        correct += np.sum((model.predict(images)[:, 0] > .5) == labels)
+        total += len(labels)
+    return float(correct / total)
+
+def artifact_report(model, path, test_generator, args):
+    return {
+        'path': os.path.basename(path),
+        'size_mb': os.path.getsize(path) / 2**20,
+        'load_seconds': load_seconds(path),
+        'test_accuracy': test_accuracy(model, test_generator, args),
+        'kernel_sparsity': kernel_sparsity(model),
+        'cpu_latency_ms': cpu_latency(model, args),
+    }
+
+def prune_and_compare(model, args, train_generator, test_generator):
+    # prunes the trained model in place and reports its compressed artifact against the
+    # trained model's .h5 file and against that file gzipped, which separates what pruning
+    # saves from what dropping the optimizer state and gzip save on their own
+    baseline = artifact_report(model, os.path.join(args.model_dir, 'cv_chart_model.h5'), test_generator, args)
+    with tempfile.TemporaryDirectory() as tmp:
+        baseline['gzip_size_mb'] = os.path.getsize(save_compressed(model, os.path.join(tmp, 'model.h5.gz'))) / 2**20
+
+    pruning = MagnitudePruning(args.prune_sparsity, args.prune_epochs)
+    train_model(model, args, train_generator, test_generator, epochs=args.prune_epochs, callbacks=[pruning])
+    path = save_compressed(model, os.path.join(args.model_dir, 'cv_chart_model_pruned.h5.gz'))
+    report = {'sparsity': args.prune_sparsity, 'epochs': args.prune_epochs,
+              'baseline': baseline, 'pruned': artifact_report(model, path, test_generator, args)}
+
+    for name in ('baseline', 'pruned'):
+        r = report[name]
+        latency = ', '.join(f"{batch} {ms:.2f}ms" for batch, ms in r['cpu_latency_ms'].items())
+        print(f"{name}: {r['path']} {r['size_mb']:.2f}MB, loads in {r['load_seconds']:.2f}s, "
+              f"test accuracy {r['test_accuracy']:.3f}, {100 * r['kernel_sparsity']:.1f}% zeros, cpu latency {latency}")
+    print(f"the trained model gzipped without optimizer state is {baseline['gzip_size_mb']:.2f}MB")
+    return report
+
+def count_flops(model):
+    # floating point operations of one forward pass on one image, counting a multiply-add
+    # as two. only convolutions and dense layers, which is where nearly all the work is.
+    flops = 0
+    for layer in model.layers:
+        if isinstance(layer, (Conv2D, SeparableConv2D)):
+            _, out_h, out_w, out_c = layer.output_shape
+            in_c = layer.input_shape[-1]
+            k_h, k_w = layer.kernel_size
+            if isinstance(layer, SeparableConv2D):
+                flops += 2 * out_h * out_w * (k_h * k_w * in_c + in_c * out_c)
+            else:
+                flops += 2 * out_h * out_w * k_h * k_w * in_c * out_c
+        elif isinstance(layer, Dense):
+            flops += 2 * layer.input_shape[-1] * layer.units
+    return flops
+
+def cpu_latency_ms(model, batch_size, n_runs):
+    # median time of a forward pass on random input after a warmup call. in TF 2.x
+    # predict_on_batch adds tens of milliseconds of per call overhead that would drown the
+    # differences between architectures, so the compiled forward pass is timed instead.
+    if tf.executing_eagerly():
+        @tf.function
+        def forward(batch):
+            return model(batch, training=False)
+    else:
+        forward = model.predict_on_batch
+    _, height, width, channels = model.input_shape
+    batch = np.random.rand(batch_size, height, width, channels).astype(np.float32)
+    forward(batch)
+    times = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        forward(batch)
+        times.append(time.perf_counter() - start)
+    return 1000 * float(np.median(times))
+
+def cpu_latency(model, args):
+    # cpu_latency_ms of a single image and of a training batch, with a tenth of the runs
+    return {'batch_1': cpu_latency_ms(model, 1, args.n_latency_runs),
+            f'batch_{args.batch_size}': cpu_latency_ms(model, args.batch_size, max(1, args.n_latency_runs // 10))}
+
+def model_report(model, history, args):
+    # what the architecture costs at inference time next to how well it did. keras names
+    # the metric acc in TF 1.x and accuracy in TF 2.x.
+    val_acc = history.history.get('val_accuracy') or history.history.get('val_acc') or [None]
+    return {
+        'val_accuracy': float(val_acc[-1]) if val_acc[-1] is not None else None,
+        'params': int(model.count_params()),
+        'flops': int(count_flops(model)),
+        'cpu_latency_ms': cpu_latency(model, args),
+        'architecture': {'img_size': args.img_size, 'head': args.head, 'conv_type': args.conv_type},
+    }
+
+def print_report(name, report):
+    latency = ', '.join(f"{batch} {ms:.2f}ms" for batch, ms in report['cpu_latency_ms'].items())
+    val_acc = f"{report['val_accuracy']:.3f}" if report['val_accuracy'] is not None else "-"
+    print(f"{name}: val accuracy {val_acc}, {report['params']:,} params, "
+          f"{report['flops'] / 1e6:.1f} MFLOPs, cpu latency {latency}")
+
+def save_model(model, model_dir):
+    # a SavedModel for tensorflow serving and the .h5 file the flask api loads
+    if hasattr(tf, 'contrib'):
+        tf.contrib.saved_model.save_keras_model(model, model_dir)
+    else:
+        # TF 2.x has no contrib, serving still looks for numbered version directories
+        tf.saved_model.save(model, os.path.join(model_dir, '1'))
+    model.save(os.path.join(model_dir, 'cv_chart_model.h5'))
+
+if __name__ == "__main__":
+
+    args, _ = parse_args()
+    hvd = init_distributed(args)
+    rank, n_workers = (hvd.rank(), hvd.size()) if hvd is not None else (0, 1)
+    configure_threads(args.intra_op_threads, args.inter_op_threads)
+    get_data_gens = get_shard_data_gens if args.data_format == 'shards' else get_image_data_gens
+    train_generator, test_generator = get_data_gens(args.train, args.test, args.batch_size, args.img_size,
+                                                    rank, n_workers)
+    model = create_model(args.n_conv_layers, args.n_filters, args.kernel_sizes, args.img_size,
+                         head=args.head, conv_type=args.conv_type)
+    history, throughput = train_model(model, args, train_generator, test_generator,
+                                      args.progress_file if rank == 0 else None, hvd)
+    training_reports = {'model': throughput}
+
+    if args.train_cascade:
+        small_model = create_model(args.cascade_n_conv_layers, args.cascade_n_filters, args.cascade_kernel_sizes,
+                                   args.img_size, downsample=args.cascade_downsample,
+                                   head=args.head, conv_type=args.conv_type)
+        small_history, training_reports['cascade_small_model'] = train_model(small_model, args, train_generator,
+                                                                             test_generator, hvd=hvd)
+
+    # every process ends up with the same weights, the first one saves and reports
+    if rank == 0:
+        # save model for serving later
+        save_model(model, args.model_dir)
+
+        reports = {'model': model_report(model, history, args)}
+        print_report('model', reports['model'])
+
+        if args.train_cascade:
+            evaluate_cascade(small_model, model, test_generator, args)
+            # only the h5 file, a second SavedModel in model_dir would be served as the model
+            small_model.save(os.path.join(args.model_dir, 'cv_chart_model_small.h5'))
+            reports['cascade_small_model'] = model_report(small_model, small_history, args)
+            print_report('cascade small model', reports['cascade_small_model'])
+
+        with open(os.path.join(args.model_dir, 'model_report.json'), 'w') as f:
+            json.dump(reports, f, indent=2)
+        with open(os.path.join(args.model_dir, 'training_report.json'), 'w') as f:
+            json.dump({'config': {'data_format': args.data_format, 'batch_size': args.batch_size, 'workers': args.workers,
+                                  'max_queue_size': args.max_queue_size, 'distributed_processes': n_workers},
+                       'epochs': training_reports}, f, indent=2)
 
-    # save model for serving later
-    tf.contrib.saved_model.save_keras_model(model, args.model_dir)
\ No newline at end of file
+        if args.prune:
+            # fine-tunes in this process only, on its part of the data in data parallel training
+            pruning_report = prune_and_compare(model, args, train_generator, test_generator)
+            with open(os.path.join(args.model_dir, 'pruning_report.json'), 'w') as f:
+                json.dump(pruning_report, f, indent=2)